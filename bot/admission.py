@@ -0,0 +1,142 @@
+import collections
+import json
+import logging
+import threading
+import time
+import typing as tp
+
+import numpy as np
+
+# Super resolution tiers from the most to the least expensive
+SR_TIERS = ('espcn', 'lanczos', 'none')
+
+
+class CostModel:
+    """
+    Linear model of the CPU-seconds of a job:
+    overhead + frames * (per frame + per input megapixel + per output megapixel of ESPCN).
+    Fitted by ridge regression on the last jobs, pulled towards the prior while there are few of them.
+    """
+
+    FEATURES = ('overhead', 'frame', 'input_mpix', 'sr_mpix')
+
+    def __init__(self, prior: tp.Sequence[float] = (10.0, 1.0, 0.1, 0.5), history: int = 200,
+                 strength: float = 3.0):
+        self.prior = np.array(prior, dtype=np.float64)
+        self.strength = strength
+        self.weights = self.prior.copy()
+        self._history = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def features(frames: int, width: int, height: int, sr_tier: str, sr_scale: int = 4):
+        sr_mpix = (256 * sr_scale) ** 2 / 1e6 if sr_tier == 'espcn' else 0.0
+        return np.array([1.0, frames, frames * width * height / 1e6, frames * sr_mpix])
+
+    def predict(self, **job):
+        return max(0.0, float(self.features(**job) @ self.weights))
+
+    def observe(self, cpu_seconds: float, **job):
+        with self._lock:
+            self._history.append((self.features(**job), cpu_seconds))
+            self.fit()
+
+    def fit(self):
+        x = np.stack([features for features, _ in self._history])
+        y = np.array([cost for _, cost in self._history])
+        # Features differ by orders of magnitude, so the penalty is scaled by their typical size
+        scale = np.maximum(np.abs(x).mean(axis=0), 1e-6)
+        penalty = self.strength * np.diag(scale ** 2)
+        weights = np.linalg.solve(x.T @ x + penalty, x.T @ y + penalty @ self.prior)
+        # Every part of the job costs something, negative weights come only from noise
+        self.weights = np.maximum(weights, 0)
+
+    def load(self, ledger_path: str):
+        """
+        Fit the model on the jobs recorded in the ledger by previous runs
+        """
+        try:
+            with open(ledger_path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record.get('status') == 'done' and record.get('cpu_seconds') and record.get('job'):
+                        self._history.append((self.features(**record['job']), record['cpu_seconds']))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Can't read job ledger {ledger_path}: {e}")
+        if self._history:
+            self.fit()
+            logging.info(f"Cost model fitted on {len(self._history)} jobs: {self.weights}")
+
+
+class Decision:
+    """
+    What to do with a job: 'admit', 'downsample' (admit with a cheaper SR tier),
+    'queue' (admit, but start in `delay` seconds) or 'reject'
+    """
+
+    def __init__(self, action: str, job: dict, cost: float, delay: float = 0):
+        self.action = action
+        self.job = job
+        self.cost = cost
+        self.delay = delay
+
+    def __repr__(self):
+        return f"Decision({self.action}, {self.job}, cost={self.cost:.1f}, delay={self.delay:.1f})"
+
+
+class Admission:
+    """
+    Token bucket of CPU-seconds: `budget` seconds per `window`, jobs are charged with their predicted cost
+    and the difference with the measured cost is settled when they finish.
+    """
+
+    def __init__(self, model: CostModel, budget: float, window: float, max_wait: float):
+        self.model = model
+        self.budget = budget
+        self.rate = budget / window
+        self.max_wait = max_wait
+        self._tokens = budget
+        self._updated = time.time()
+
+    def available(self):
+        now = time.time()
+        self._tokens = min(self.budget, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return self._tokens
+
+    def decide(self, job: dict):
+        """
+        job - frames, width, height, sr_tier and sr_scale of the request
+        """
+        available = self.available()
+        cost = self.model.predict(**job)
+        if cost <= available:
+            return Decision('admit', job, cost)
+
+        tiers = SR_TIERS[SR_TIERS.index(job['sr_tier']) + 1:] if job['sr_tier'] in SR_TIERS else ()
+        for tier in tiers:
+            cheaper = dict(job, sr_tier=tier)
+            cheaper_cost = self.model.predict(**cheaper)
+            if cheaper_cost <= available:
+                return Decision('downsample', cheaper, cheaper_cost)
+
+        delay = (cost - available) / self.rate
+        if cost <= self.budget and delay <= self.max_wait:
+            return Decision('queue', job, cost, delay)
+        return Decision('reject', job, cost)
+
+    def charge(self, decision: Decision):
+        self.available()
+        self._tokens -= decision.cost
+
+    def settle(self, decision: Decision, cpu_seconds: tp.Optional[float], done: bool):
+        """
+        Return the difference between the predicted and the measured cost, learn from finished jobs
+        """
+        self.available()
+        if cpu_seconds is None:
+            self._tokens += decision.cost
+            return
+        self._tokens += decision.cost - cpu_seconds
+        if done:
+            self.model.observe(cpu_seconds, **decision.job)
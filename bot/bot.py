@@ -1,48 +1,74 @@
 import asyncio
-import concurrent.futures
+import functools
 import logging
 import os
-import sys
 import time
 import typing as tp
 
 from aiogram import Bot, types
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import Dispatcher
 from aiogram.types import ReplyKeyboardRemove
 from aiogram.utils import executor, exceptions
 from aiogram.utils.emoji import emojize
 from aiogram.utils.helper import Helper, HelperMode, ListItem
-import imageio
-from moviepy.editor import *
-from skimage import img_as_ubyte
-from skimage.transform import resize
 
+from admission import Admission, CostModel
+from cache import DiskCache, file_hash, make_key
 from config import *
+from inference import chunk_ranges, join_chunks, prepare_chunks, probe_video, safe_first_order
+from metrics import JobLedger, metrics
+from scheduler import JobScheduler, QueueFull, merge_stats
+from sessions import MemorySessionStore, SqliteSessionStore
+from workers import InferencePool, JobCancelled
 
-sys.path.append("../first-order-model")
-from demo import make_animation, make_photo_animation, read_video, load_checkpoints, super_resolution
-from crop import crop_image, crop_video
-
-# Bot initialization
 TOKEN = os.environ.get('TOKEN', None)
-bot = Bot(token=TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
 
 # Logging
+logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s', level=logging.INFO)
 # logging.basicConfig(filename='log.txt',
 #                     filemode='a',
 #                     format='%(asctime)s, %(msecs) d %(name)s %(levelname) s %(message) s',
 #                     datefmt='%H:%M:%S',
 #                     level=logging.INFO)
 
-logging.info("Model was init")
-
-# Limit parallel processes
-sem = asyncio.Semaphore(5)
-
-# Global video storage
-user_videos = dict()
+# Created by setup(): every spawned inference worker imports this module again (as __mp_main__),
+# so nothing with side effects may happen at the module level
+bot = dp = pool = scheduler = result_cache = trajectory_cache = ledger = cost_model = admission = sessions = None
+
+
+def setup():
+    global bot, dp, pool, scheduler, result_cache, trajectory_cache, ledger, cost_model, admission, sessions
+
+    # Bot initialization
+    bot = Bot(token=TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API)) if TELEGRAM_API else Bot(token=TOKEN)
+    dp = Dispatcher(bot, storage=MemoryStorage())
+    register_handlers(dp)
+
+    # Inference workers, started in on_startup
+    pool = InferencePool(WORKERS, config_path=CONFIG, checkpoint_path=CHECKPOINT, cpu=CPU,
+                         torch_threads=TORCH_THREADS, pin_cpus=PIN_CPUS, backend=BACKEND,
+                         onnx_dir=ONNX_DIR or None)
+    scheduler = JobScheduler(pool, max_queued=MAX_QUEUED, update_interval=STATUS_UPDATE_INTERVAL)
+    result_cache = DiskCache(CACHE_DIR, CACHE_MAX_BYTES)
+    trajectory_cache = DiskCache(TRAJECTORY_CACHE_DIR, TRAJECTORY_CACHE_MAX_BYTES)
+    ledger = JobLedger(JOB_LEDGER)
+    cost_model = CostModel()
+    cost_model.load(JOB_LEDGER)
+    admission = Admission(cost_model, budget=ADMISSION_BUDGET, window=ADMISSION_WINDOW,
+                          max_wait=ADMISSION_MAX_WAIT)
+    metrics.gauge('workers_alive', pool.alive)
+    metrics.gauge('workers_busy', pool.busy)
+    metrics.gauge('jobs_queued', scheduler.queued)
+    metrics.gauge('admission_budget_seconds', admission.available)
+
+    # Uploaded media of every user and the directory of the current job
+    if SESSION_DB:
+        sessions = SqliteSessionStore(SESSION_DB, PATH, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL)
+    else:
+        sessions = MemorySessionStore(PATH, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL)
+    metrics.gauge('sessions', lambda: len(sessions))
 
 
 class TestStates(Helper):
@@ -52,108 +78,6 @@ class TestStates(Helper):
     TEST_STATE_1 = ListItem()
 
 
-RELATIVE = True
-ADAPT_SCALE = True
-CPU = False
-CONFIG = '../first-order-model/config/vox-256.yaml'
-CHECKPOINT = '../first-order-model/pretrained_models/vox-cpk.pth.tar'
-PATH = 'img/'
-
-
-def prepare_data(user_id: int):
-    data = dict()
-    source = user_videos[user_id]['source']
-    target = user_videos[user_id]['target']
-
-    audio_clip = AudioFileClip(target)
-    data['audio'] = audio_clip
-
-    if source.endswith('.jpg'):
-        crop_image(source)
-    else:
-        # pass
-        crop_video(source)
-    try:
-        source_reader = imageio.get_reader('crop_' + source)
-    except FileNotFoundError:
-        print("Didn't find cropped video")
-        source_reader = imageio.get_reader(source)
-
-    if source.endswith('.jpg'):
-        data['source_media'] = resize(next(iter(source_reader)), (256, 256))[..., :3]
-        data['photo'] = True
-    else:
-        data['source_media'] = read_video(source_reader)
-        data['photo'] = False
-
-    crop_video(target)
-    try:
-        target_reader = imageio.get_reader('crop_' + target)
-    except FileNotFoundError:
-        print("Didn't find cropped video")
-        target_reader = imageio.get_reader(target)
-    fps = target_reader.get_meta_data()['fps']
-
-    data['fps'] = fps
-    data['target_media'] = read_video(target_reader)
-
-    generator, kp_detector = load_checkpoints(config_path=CONFIG,
-                                              checkpoint_path=CHECKPOINT,
-                                              cpu=CPU)
-    data['generator'] = generator
-    data['kp_detector'] = kp_detector
-    return data
-
-
-def first_order(user_id: int):
-    data = prepare_data(user_id)
-    if data['photo']:
-        predictions = make_photo_animation(
-                data['source_media'], data['target_media'],
-                data['generator'], data['kp_detector'],
-                relative=RELATIVE,
-                adapt_movement_scale=ADAPT_SCALE,
-                cpu=CPU
-        )
-    else:
-        predictions = make_animation(
-                data['source_media'], data['target_media'],
-                data['generator'], data['kp_detector'],
-                relative=RELATIVE,
-                adapt_movement_scale=ADAPT_SCALE,
-                cpu=CPU
-        )
-    # imageio.mimsave(f'{PATH}1.mp4', [img_as_ubyte(frame) for frame in predictions], "mp4", fps=data['fps'])
-    filename = f'{PATH}{user_id}'
-    imageio.mimsave(filename + '.mp4',
-                    [super_resolution(img_as_ubyte(frame), 4) for frame in predictions],
-                    "mp4", fps=data['fps'])
-    video_clip = VideoFileClip(filename + '.mp4')
-    video_clip.audio = data['audio']
-    try:
-        video_clip.write_videofile(filename + '_a' + '.mp4')
-    except Exception as e:
-        print(e)
-        video_clip = VideoFileClip(filename + '.mp4')
-        video_clip.write_videofile(filename + '_a' + '.mp4')
-
-
-def safe_first_order(user_id: int):
-    """
-    Safe run of first_order - Semaphore limits max processes in parallel
-    """
-    start = time.time()
-    try:
-        first_order(user_id)
-    except Exception as e:
-        print(e)
-        logging.warning(e)
-        return False
-    end = time.time()
-    logging.info(f"Video processing took {end - start}")
-    return True
-
-
 async def change_state(user_id: int, new_state: tp.Optional[int]):
     state = dp.current_state(user=user_id)
     if new_state is None or new_state >= len(TestStates.all()):
@@ -193,18 +117,24 @@ async def save_media(message: types.Message, key: str):
             logging.info("Took too long video")
             return False
 
+    user_id = message.from_user.id
+    # Every target starts a new job, the source joins the job of the last target
+    session = sessions.new_job(user_id) if key == 'target' else sessions.get(user_id)
+    if session is None or session['target'] is None and key != 'target':
+        await message.answer("Сначала отправь видео, из которого нужно перенести мимику")
+        await change_state(user_id, None)
+        return False
+
     try:
-        filename = f"{PATH}{key}{message.from_user.id}{ext}"
-        await media.download(filename)
+        filename = f"{session['dir']}{key}{ext}"
+        with metrics.timer('download'):
+            await media.download(filename)
     except exceptions.FileIsTooBig:
         await message.answer("Телеграм не поддерживает файлы свыше 20 Мб, "
                              "попробуйте отправить ваше видео со сжатием")
         return False
 
-    if message.from_user.id not in user_videos:
-        user_videos[message.from_user.id] = EMPTY_DICT
-
-    user_videos[message.from_user.id][key] = filename
+    sessions.update(user_id, **{key: filename})
     if photo:
         await message.answer("Фото успешно загружено")
     else:
@@ -212,38 +142,226 @@ async def save_media(message: types.Message, key: str):
     return True
 
 
+async def hash_files(*paths: str):
+    loop = asyncio.get_running_loop()
+    return [await loop.run_in_executor(None, file_hash, path) for path in paths]
+
+
+def result_key(source_hash: str, target_hash: str, sr_tier: str = SR_TIER):
+    """
+    Cache key of the result: content of both inputs and every setting that changes the output
+    """
+    return make_key(source_hash, target_hash, relative=RELATIVE, adapt_scale=ADAPT_SCALE, sr_tier=sr_tier,
+                    sr_scale=SR_SCALE, render_fps=RENDER_FPS, reuse_threshold=REUSE_THRESHOLD,
+                    source_window=SOURCE_WINDOW,
+                    config=os.path.basename(CONFIG), checkpoint=os.path.basename(CHECKPOINT))
+
+
+def trajectory_key(target_hash: str):
+    """
+    Cache key of the driving keypoints: they depend only on the target and the keypoint detector
+    """
+    return make_key(target_hash, config=os.path.basename(CONFIG), checkpoint=os.path.basename(CHECKPOINT))
+
+
+async def send_result(message: types.Message, key: str, path: str):
+    """
+    Upload the video and remember its file_id, so the same result is never uploaded again
+    """
+    with metrics.timer('upload'):
+        reply = await message.answer_video(open(path, 'rb'))
+    media = reply.video or reply.animation or reply.document
+    if media is not None:
+        # Copying the result and saving the index must not block the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(result_cache.put, key, path, file_id=media.file_id))
+
+
+async def send_cached(message: types.Message, key: str):
+    entry = await asyncio.get_running_loop().run_in_executor(None, result_cache.get, key)
+    if entry is None:
+        return False
+    logging.info(f"Cache hit for user {message.from_user.id}")
+    if entry['meta'].get('file_id') is not None:
+        await message.answer_video(entry['meta']['file_id'])
+        return True
+    path = result_cache.path(key)
+    if path is not None:
+        await send_result(message, key, path)
+        return True
+    return False
+
+
+def record_job(stats: dict, status: str):
+    stats['status'] = status
+    metrics.observe_job(stats)
+    ledger.write(stats)
+
+
+async def render_chunked(user_id: int, source: str, target: str, output: str, trajectory_path: tp.Optional[str],
+                         trajectory_out: tp.Optional[str], sr_tier: str, preview_path: tp.Optional[str],
+                         info: dict, stats: dict, delay: float, on_update: tp.Callable, on_preview: tp.Callable):
+    """
+    The first job crops the source and computes the trajectory of the target, then every chunk of frames
+    is rendered by its own job and the chunks are joined with the sound of the target
+    """
+    started = time.time()
+    prepare_stats, chunk_stats = dict(), dict()
+    try:
+        plan = await scheduler.submit(user_id, prepare_chunks, source, target, trajectory_path, trajectory_out,
+                                      frames=info['rendered_frames'], on_update=on_update, stats=prepare_stats,
+                                      delay=delay)
+        if plan is None:
+            return False
+        chunks = chunk_ranges(plan['frames'], WORKERS, info['stride'])
+        logging.info(f"Rendering {plan['frames']} frames of user {user_id} by chunks {chunks}")
+        parts = [f'{output}_part{i}' for i in range(len(chunks))]
+        calls = [(safe_first_order, (source, target, part, plan['trajectory'], None, sr_tier,
+                                     preview_path if i == 0 else None, chunk))
+                 for i, (part, chunk) in enumerate(zip(parts, chunks))]
+        frames = [(stop - start + info['stride'] - 1) // info['stride'] for start, stop in chunks]
+        # safe_first_order returns False on errors, the other chunks are not needed then
+        results = await scheduler.submit_group(user_id, calls, frames, on_update=on_update, stats=chunk_stats,
+                                               on_preview=on_preview, accept=bool)
+        if results is None:
+            return False
+        start = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, join_chunks, [part + '.mp4' for part in parts],
+                                                         output, target)
+        chunk_stats.setdefault('stages', dict())['join'] = time.perf_counter() - start
+        return True
+    finally:
+        stats.update(merge_stats([prepare_stats, chunk_stats]))
+        if 'queue_wait' in prepare_stats:
+            stats['queue_wait'] = prepare_stats['queue_wait']
+            stats['run_seconds'] = time.time() - started - stats['queue_wait']
+            if stats.get('frames'):
+                stats['fps'] = stats['frames'] / stats['run_seconds']
+
+
 async def process_video(message: types.Message):
     await message.answer("Начал обработку видео",
                          reply_markup=ReplyKeyboardRemove())
     await message.answer(emojize(":hourglass_flowing_sand:"))
     await change_state(message.from_user.id, None)
 
+    user_id = message.from_user.id
+    session = sessions.update(user_id, busy=True)
+    if session is None:
+        await message.answer("Файлы устарели, попробуй начать сначала и отправить видео, "
+                             "из которого нужно перенести мимику")
+        return
+    try:
+        await render(message, session)
+    finally:
+        # Every file of the job lives in its directory: inputs, crops, trajectory, preview, parts and output
+        sessions.finish(user_id, session)
+
+
+async def render(message: types.Message, session: dict):
+    user_id = message.from_user.id
+    source = session['source']
+    target = session['target']
+    source_hash, target_hash = await hash_files(source, target)
+    key = result_key(source_hash, target_hash)
+    if await send_cached(message, key):
+        return
+
+    # Admission control against the CPU budget
+    info = await asyncio.get_running_loop().run_in_executor(None, probe_video, target)
+    decision = admission.decide({'frames': info['rendered_frames'], 'width': info['width'],
+                                 'height': info['height'], 'sr_tier': SR_TIER, 'sr_scale': SR_SCALE})
+    logging.info(f"Admission of user {user_id}: {decision}")
+    metrics.inc('admission_total', action=decision.action)
+    if decision.action == 'reject':
+        await message.answer("Сейчас сервис перегружен, а это видео слишком тяжелое для обработки. "
+                             "Попробуй отправить видео покороче или чуть позже")
+        return
+    sr_tier = decision.job['sr_tier']
+    if decision.action == 'downsample':
+        await message.answer("Сейчас высокая нагрузка, поэтому видео будет в упрощенном качестве")
+        key = result_key(source_hash, target_hash, sr_tier)
+        if await send_cached(message, key):
+            return
+    admission.charge(decision)
+
     # Run first order model
-    loop = asyncio.get_running_loop()
-    with concurrent.futures.ThreadPoolExecutor() as pool:
-        async with sem:
-            res = await loop.run_in_executor(
-                pool, safe_first_order, message.from_user.id)
+    status = await message.answer("Задача поставлена в очередь")
+
+    async def on_update(position: int, eta: float):
+        if position == 0:
+            text = f"Обрабатываю видео, осталось примерно {int(eta)} сек"
+        else:
+            text = f"Ты #{position} в очереди, ожидание примерно {int(eta)} сек"
+        if status.text != text:
+            await status.edit_text(text)
+            status.text = text
+
+    async def on_preview(path: str):
+        with metrics.timer('preview_upload'):
+            await message.answer_animation(open(path, 'rb'), caption="Вот первые секунды, "
+                                                                     "полное видео скоро будет готово")
+        os.remove(path)
+
+    # A popular target is cropped and processed by the keypoint detector only once
+    kp_key = trajectory_key(target_hash)
+    trajectory_entry = await asyncio.get_running_loop().run_in_executor(None, trajectory_cache.get, kp_key)
+    trajectory_path = trajectory_cache.path(kp_key) if trajectory_entry is not None else None
+    trajectory_out = None if trajectory_path is not None else f"{session['dir']}target_kp.npz"
+
+    stats = {'user_id': user_id, 'key': key, 'cached_trajectory': trajectory_path is not None,
+             'job': decision.job, 'predicted_cpu_seconds': decision.cost}
+    output = f"{session['dir']}result"
+    preview_path = f"{session['dir']}preview.mp4" if PREVIEW_SECONDS > 0 else None
+    # A long photo animation doesn't depend on previous frames, so it can be rendered by several workers
+    chunked = CHUNK_FRAMES > 0 and WORKERS > 1 and source.endswith('.jpg') and info['frames'] >= 2 * CHUNK_FRAMES
+    try:
+        if chunked:
+            res = await render_chunked(user_id, source, target, output, trajectory_path, trajectory_out, sr_tier,
+                                       preview_path, info, stats, decision.delay, on_update, on_preview)
+        else:
+            res = await scheduler.submit(user_id, safe_first_order, source, target, output,
+                                         trajectory_path, trajectory_out, sr_tier, preview_path,
+                                         frames=info['rendered_frames'],
+                                         on_update=on_update,
+                                         stats=stats,
+                                         delay=decision.delay,
+                                         on_preview=on_preview)
+    except JobCancelled:
+        # The user has already sent new media, the new job has its own directory
+        logging.info(f"Job of user {user_id} was cancelled")
+        admission.settle(decision, stats.get('cpu_seconds'), done=False)
+        record_job(stats, 'cancelled')
+        return
+    except QueueFull:
+        admission.settle(decision, None, done=False)
+        await message.answer("Сейчас слишком много желающих, попробуй отправить видео чуть позже")
+        metrics.inc('jobs_rejected_total')
+        return
+    except RuntimeError as e:
+        logging.warning(e)
+        res = False
+    admission.settle(decision, stats.get('cpu_seconds'), done=bool(res))
+    record_job(stats, 'done' if res else 'failed')
     if not res:
         await message.answer("В процессе обработки возникла ошибка.\n"
                              "Скорее всего, на одном из видео/фото алгоритм не смог распознать лица.\n"
                              "Попробуй начать сначала и отправить видео, из которого нужно перенести мимику")
     else:
+        if trajectory_out is not None and os.path.exists(trajectory_out):
+            await asyncio.get_running_loop().run_in_executor(None, trajectory_cache.put, kp_key, trajectory_out)
         # await message.answer_video(open(f'{PATH}{message.from_user.id}.mp4', 'rb'))
-        await message.answer_video(open(f'{PATH}{message.from_user.id}_a.mp4', 'rb'))
-    os.system(f"rm img/target{message.from_user.id}* crop_img/*{message.from_user.id}*")
+        await send_result(message, key, f'{output}_a.mp4')
     # await message.answer(f"Отправляю обработанное видео")
 
 
-@dp.message_handler(commands=['start'])
 async def send_welcome(message: types.Message) -> None:
-    user_videos[message.from_user.id] = EMPTY_DICT
+    sessions.remove(message.from_user.id)
     await message.answer("Привет, {}!\n".format(message.from_user.first_name) +
                          "Я бот, который поможет тебе предстать в совершенно новом облике\n"
                          "Отправь видео, в котором ты хочешь оказаться")
 
 
-@dp.message_handler(commands=['help'])
 async def send_help(message: types.Message) -> None:
     logging.info(f"User {message.from_user.id} asked for help")
     await message.answer("Нужна помощь? Решение очень простое!\n" +
@@ -252,12 +370,31 @@ async def send_help(message: types.Message) -> None:
                          "бот предоставит тебе такую возможность после выбора таргетного видео.")
 
 
-@dp.message_handler(content_types=['video', 'video_note', 'animation'])
+def awaits_source(session: tp.Optional[dict]) -> bool:
+    """
+    The job of the session has a target and waits for the source
+    """
+    return session is not None and session['target'] is not None and session['source'] is None \
+        and not session['busy']
+
+
+async def handle_media(message: types.Message):
+    # Routed by the session, not by the FSM state: the session store survives a restart, MemoryStorage doesn't
+    if message.content_type != 'animation' and awaits_source(sessions.get(message.from_user.id)):
+        await handle_source_video(message)
+    elif message.content_type == 'photo':
+        await message.answer("Сначала отправь видео, из которого нужно перенести мимику")
+    else:
+        await handle_target_video(message)
+
+
 async def handle_target_video(message: types.Message):
+    # New target: the previous job of this user is not needed anymore
+    scheduler.cancel(message.from_user.id)
     if not await save_media(message, 'target'):
         return
 
-    # if user_videos[message.from_user.id]['source'] is None:
+    # if sessions.get(message.from_user.id)['source'] is None:
     await ask_for_source(message)
     # else:
     #     await change_state(message.from_user.id, 0)
@@ -267,12 +404,10 @@ async def handle_target_video(message: types.Message):
     #                          reply_markup=markup_source)
 
 
-@dp.message_handler()
 async def handle_text(message: types.Message):
     await message.answer("Жду видео, из которого нужно перенести мимику:)")
 
 
-@dp.message_handler(state=TestStates.TEST_STATE_0)
 async def choose_source_video(message: types.Message):
     if message.text.strip() == CHANGE_VIDEO:
         await ask_for_source(message)
@@ -283,7 +418,6 @@ async def choose_source_video(message: types.Message):
                              reply_markup=markup_source)
 
 
-@dp.message_handler(state=TestStates.TEST_STATE_1, content_types=['photo', 'video', 'video_note'])
 async def handle_source_video(message: types.Message):
     if not await save_media(message, 'source'):
         return
@@ -291,5 +425,50 @@ async def handle_source_video(message: types.Message):
     await process_video(message)
 
 
+def register_handlers(dispatcher: Dispatcher):
+    dispatcher.register_message_handler(send_welcome, commands=['start'])
+    dispatcher.register_message_handler(send_help, commands=['help'])
+    dispatcher.register_message_handler(handle_media, state='*',
+                                        content_types=['photo', 'video', 'video_note', 'animation'])
+    dispatcher.register_message_handler(handle_text)
+    dispatcher.register_message_handler(choose_source_video, state=TestStates.TEST_STATE_0)
+
+
+async def expire_sessions():
+    while True:
+        await asyncio.sleep(SESSION_EXPIRE_INTERVAL)
+        sessions.expire()
+
+
+async def on_startup(dispatcher: Dispatcher):
+    sessions.recover()
+    # Every worker loads and warms up its models before the first job arrives
+    pool.start()
+    await pool.wait_ready()
+    scheduler.start()
+    dispatcher['session_expiry'] = asyncio.get_running_loop().create_task(expire_sessions())
+    if METRICS_PORT:
+        # Metrics are optional, a busy port must not stop the bot
+        try:
+            dispatcher['metrics_runner'] = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logging.error(f"Metrics are not served, can't listen on {METRICS_HOST}:{METRICS_PORT}: {e}")
+    logging.info("Model was init")
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    if dispatcher.get('session_expiry') is not None:
+        dispatcher['session_expiry'].cancel()
+    scheduler.stop()
+    pool.shutdown()
+    result_cache.flush()
+    trajectory_cache.flush()
+    if isinstance(sessions, SqliteSessionStore):
+        sessions.close()
+    if dispatcher.get('metrics_runner') is not None:
+        await dispatcher['metrics_runner'].cleanup()
+
+
 if __name__ == '__main__':
-    executor.start_polling(dp)
+    setup()
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
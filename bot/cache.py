@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import typing as tp
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20):
+    """
+    sha256 of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(*parts, **settings):
+    """
+    Cache key for content hashes and the settings that influence the result
+    """
+    payload = json.dumps({'parts': parts, 'settings': settings}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class DiskCache:
+    """
+    Directory of files with a JSON index, evicted in LRU order to stay within max_bytes.
+    Every entry also keeps small metadata (e.g. Telegram file_id), which outlives the evicted file.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_entries: int = 10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.index_path = os.path.join(directory, 'index.json')
+        self._lock = threading.Lock()
+        # Reads only touch 'used', it is written with the next put or flush
+        self._dirty = False
+        os.makedirs(directory, exist_ok=True)
+        self._index = self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return dict()
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Cache index is broken, starting from scratch: {e}")
+            return dict()
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
+
+    def path(self, key: str):
+        """
+        Path of the cached file, None if there is no file for the key
+        """
+        entry = self._index.get(key)
+        if entry is None or entry['file'] is None:
+            return None
+        return os.path.join(self.directory, entry['file'])
+
+    def get(self, key: str) -> tp.Optional[dict]:
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            if entry['file'] is not None and not os.path.exists(os.path.join(self.directory, entry['file'])):
+                entry.update(file=None, size=0)
+            entry['used'] = time.time()
+            self._dirty = True
+            return dict(entry)
+
+    def put(self, key: str, path: tp.Optional[str] = None, **meta):
+        """
+        Copy the file at path into the cache (if given) and update the metadata of the key
+        """
+        with self._lock:
+            entry = self._index.setdefault(key, {'file': None, 'size': 0, 'meta': dict()})
+            if path is not None:
+                name = key + os.path.splitext(path)[1]
+                cached_path = os.path.join(self.directory, name)
+                if os.path.abspath(path) != os.path.abspath(cached_path):
+                    shutil.copyfile(path, cached_path)
+                entry.update(file=name, size=os.path.getsize(path))
+            entry['meta'].update(meta)
+            entry['used'] = time.time()
+            self._evict()
+            self._save_index()
+
+    def flush(self):
+        """
+        Save the index if reads changed it since the last save
+        """
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def size(self):
+        return sum(entry['size'] for entry in self._index.values())
+
+    def _evict(self):
+        total = self.size()
+        for key, entry in sorted(self._index.items(), key=lambda item: item[1]['used']):
+            if total <= self.max_bytes:
+                break
+            if entry['file'] is not None:
+                try:
+                    os.remove(os.path.join(self.directory, entry['file']))
+                except OSError:
+                    pass
+                total -= entry['size']
+                entry.update(file=None, size=0)
+        for key, entry in sorted(self._index.items(), key=lambda item: item[1]['used']):
+            if len(self._index) <= self.max_entries:
+                break
+            if entry['file'] is None:
+                del self._index[key]
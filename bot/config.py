@@ -1,7 +1,8 @@
+import os
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 
 
-EMPTY_DICT = {'source': None, 'target': None}
 CONTINUE = 'Продолжить'
 CHANGE_VIDEO = 'Поменять фото/видео'
 
@@ -9,3 +10,95 @@ buttons_source = [KeyboardButton(CONTINUE),
                   KeyboardButton(CHANGE_VIDEO)]
 markup_source = ReplyKeyboardMarkup(resize_keyboard=True,
                                     one_time_keyboard=True).add(*buttons_source)
+
+# Bot API server, e.g. the local fake_telegram.py of loadtest.py (empty - api.telegram.org)
+TELEGRAM_API = os.environ.get('TELEGRAM_API', '')
+
+# Model settings
+RELATIVE = True
+ADAPT_SCALE = True
+CPU = False
+CONFIG = '../first-order-model/config/vox-256.yaml'
+CHECKPOINT = '../first-order-model/pretrained_models/vox-cpk.pth.tar'
+# Super resolution: 'espcn' (best, slowest), 'lanczos' or 'none' (256x256 output)
+SR_TIER = os.environ.get('SR_TIER', 'espcn')
+SR_SCALE = int(os.environ.get('SR_SCALE', 4))
+PATH = 'img/'
+
+# Sessions: uploaded media of a user waiting for the next message, every job gets its own directory in PATH.
+# Dropped with their files after SESSION_TTL seconds of silence or when there are more than MAX_SESSIONS.
+# SESSION_DB - SQLite file to keep sessions across restarts (empty - in memory)
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 3600))
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', 1000))
+SESSION_DB = os.environ.get('SESSION_DB', '')
+SESSION_EXPIRE_INTERVAL = 60
+
+# Inference backend: 'torch' or 'onnx' (ONNX Runtime, CPU only, graphs exported by first-order-model/backends.py
+# to ONNX_DIR, empty - next to the checkpoint). ONNX models are checked against torch when a worker starts.
+BACKEND = os.environ.get('BACKEND', 'torch')
+ONNX_DIR = os.environ.get('ONNX_DIR', '')
+
+# CPUs the bot may run on: a container or a cpuset may allow fewer than os.cpu_count()
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+# Inference workers
+WORKERS = int(os.environ.get('WORKERS', 2))
+TORCH_THREADS = int(os.environ.get('TORCH_THREADS', max(1, CPU_COUNT // WORKERS)))
+PIN_CPUS = os.environ.get('PIN_CPUS', '1') == '1'
+
+# Frames in one forward pass of the models, None - choose by free memory
+BATCH_SIZE = None
+
+# Generate at most RENDER_FPS frames per second, the frames in between are interpolated (0 - every frame)
+RENDER_FPS = float(os.environ.get('RENDER_FPS', 0))
+
+# A frame of a photo animation whose keypoints moved less than this since the last generated frame
+# repeats that frame (0 - generate every frame)
+REUSE_THRESHOLD = float(os.environ.get('REUSE_THRESHOLD', 0))
+
+# The source frame of a video source is the nearest one by keypoints within SOURCE_WINDOW frames of the previous
+# choice (0 - the whole source video)
+SOURCE_WINDOW = int(os.environ.get('SOURCE_WINDOW', 20))
+
+# Photo animations of at least 2 * CHUNK_FRAMES frames are split into chunks rendered by several workers at once
+# (0 - never split)
+CHUNK_FRAMES = int(os.environ.get('CHUNK_FRAMES', 150))
+
+# Streaming pipeline: frames waiting between two stages, threads for super resolution
+PIPELINE_QUEUE_SIZE = 8
+SR_THREADS = 2
+
+# Preview: the first seconds of the animation at 256px without super resolution, sent before the full result.
+# Every PREVIEW_STRIDE-th frame is used, 0 seconds - no preview
+PREVIEW_SECONDS = float(os.environ.get('PREVIEW_SECONDS', 3))
+PREVIEW_STRIDE = 1
+
+# Encoding of the result, audio of the target is copied as is
+VIDEO_CODEC = 'libx264'
+VIDEO_PRESET = 'veryfast'
+VIDEO_CRF = 20
+VIDEO_PIX_FMT = 'yuv420p'
+
+# Job queue
+MAX_QUEUED = int(os.environ.get('MAX_QUEUED', 20))
+STATUS_UPDATE_INTERVAL = 5
+
+# Admission control: CPU-seconds the workers may spend per window, jobs that would exceed it
+# are downsampled (cheaper super resolution), held back for at most ADMISSION_MAX_WAIT seconds or rejected
+ADMISSION_WINDOW = 600
+ADMISSION_BUDGET = float(os.environ.get('ADMISSION_BUDGET', ADMISSION_WINDOW * CPU_COUNT))
+ADMISSION_MAX_WAIT = 300
+
+# Metrics: Prometheus text endpoint (port 0 - disabled, e.g. METRICS_PORT=9100 to enable) and a JSON line
+# per finished job
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+JOB_LEDGER = os.environ.get('JOB_LEDGER', 'logs/jobs.jsonl')
+
+# Cache of rendered results
+CACHE_DIR = 'cache/results/'
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# Cache of driving keypoints, shared by all users of the same target video
+TRAJECTORY_CACHE_DIR = 'cache/trajectories/'
+TRAJECTORY_CACHE_MAX_BYTES = int(os.environ.get('TRAJECTORY_CACHE_MAX_BYTES', 256 * 1024 ** 2))
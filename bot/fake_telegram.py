@@ -0,0 +1,197 @@
+import asyncio
+import collections
+import itertools
+import logging
+import os
+import time
+
+from aiohttp import web
+
+TOKEN = '123456:fake-token'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'face2face', 'username': 'face2face_bot'}
+
+
+def ok(result):
+    return web.json_response({'ok': True, 'result': result})
+
+
+def error(code: int, description: str):
+    return web.json_response({'ok': False, 'error_code': code, 'description': description}, status=code)
+
+
+class FakeTelegram:
+    """
+    Local stand-in of the Telegram Bot API with the subset used by the bot: getMe, getWebhookInfo, deleteWebhook,
+    getUpdates, sendMessage, editMessageText, sendVideo, sendAnimation, getFile and file downloads.
+    Users are played by the owner of the server: send_video and send_photo push updates,
+    every call of the bot is recorded in `sent` per chat and can be awaited with wait_sent.
+    """
+
+    def __init__(self, token: str = TOKEN, max_upload: int = 64 * 1024 ** 2):
+        self.token = token
+        self.max_upload = max_upload
+        self.sent = collections.defaultdict(list)
+        self.uploaded_bytes = 0
+        self.polling = asyncio.Event()
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._files = dict()
+        self._uploads = set()
+        self._new_updates = asyncio.Condition()
+        self._new_sent = asyncio.Condition()
+        self._methods = {'getMe': self._get_me, 'getWebhookInfo': self._get_webhook_info,
+                         'deleteWebhook': self._delete_webhook,
+                         'getUpdates': self._get_updates, 'getFile': self._get_file,
+                         'sendMessage': self._send_message, 'editMessageText': self._edit_message_text,
+                         'sendVideo': self._send_media, 'sendAnimation': self._send_media}
+
+    async def serve(self, host: str, port: int):
+        app = web.Application(client_max_size=self.max_upload)
+        app.router.add_route('*', '/bot{token}/{method}', self._handle_method)
+        app.router.add_get('/file/bot{token}/{path:.+}', self._handle_file)
+        # Every call of the bot would be logged otherwise
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Fake Bot API is served at http://{host}:{port}")
+        return runner
+
+    # Users
+
+    def add_file(self, path: str):
+        file_id = f'file{next(self._file_ids)}'
+        self._files[file_id] = {'path': path, 'size': os.path.getsize(path)}
+        return file_id
+
+    async def send_video(self, user_id: int, path: str, width: int, height: int, duration: int):
+        video = {'file_id': self.add_file(path), 'file_unique_id': f'u{user_id}{len(self._files)}',
+                 'width': width, 'height': height, 'duration': duration, 'mime_type': 'video/mp4',
+                 'file_size': os.path.getsize(path)}
+        return await self._push(user_id, video=video)
+
+    async def send_photo(self, user_id: int, path: str, width: int, height: int):
+        photo = {'file_id': self.add_file(path), 'file_unique_id': f'u{user_id}{len(self._files)}',
+                 'width': width, 'height': height, 'file_size': os.path.getsize(path)}
+        return await self._push(user_id, photo=[photo])
+
+    async def wait_sent(self, chat_id: int, index: int, timeout: float):
+        """
+        The index-th call of the bot in the chat, None after timeout
+        """
+        async with self._new_sent:
+            try:
+                await asyncio.wait_for(self._new_sent.wait_for(lambda: len(self.sent[chat_id]) > index), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.sent[chat_id][index]
+
+    def _message(self, chat_id: int, sender: dict, **content):
+        return dict({'message_id': next(self._message_ids), 'date': int(time.time()),
+                     'chat': {'id': chat_id, 'type': 'private', 'first_name': f'user{chat_id}'},
+                     'from': sender}, **content)
+
+    async def _push(self, user_id: int, **content):
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+        update = {'update_id': next(self._update_ids), 'message': self._message(user_id, user, **content)}
+        async with self._new_updates:
+            self._updates.append(update)
+            self._new_updates.notify_all()
+        return update
+
+    async def _record(self, chat_id: int, method: str, message: dict, **extra):
+        async with self._new_sent:
+            self.sent[chat_id].append(dict({'method': method, 'time': time.time(), 'message': message}, **extra))
+            self._new_sent.notify_all()
+
+    # Bot API
+
+    async def _handle_method(self, request: web.Request):
+        if request.match_info['token'] != self.token:
+            return error(401, 'Unauthorized')
+        method = self._methods.get(request.match_info['method'])
+        if method is None:
+            logging.warning(f"Fake Bot API doesn't support {request.match_info['method']}")
+            return error(404, 'Not Found: method is not supported by the fake server')
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(request.query)
+            params.update(await request.post())
+        return await method(params)
+
+    async def _handle_file(self, request: web.Request):
+        entry = self._files.get(request.match_info['path'])
+        if request.match_info['token'] != self.token or entry is None:
+            return error(404, 'Not Found')
+        return web.FileResponse(entry['path'])
+
+    async def _get_me(self, params: dict):
+        return ok(BOT_USER)
+
+    async def _get_webhook_info(self, params: dict):
+        return ok({'url': '', 'has_custom_certificate': False, 'pending_update_count': len(self._updates)})
+
+    async def _delete_webhook(self, params: dict):
+        return ok(True)
+
+    async def _get_updates(self, params: dict):
+        self.polling.set()
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        async with self._new_updates:
+            # Updates before the offset are confirmed by the bot
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            if not self._updates and timeout > 0:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait_for(lambda: self._updates), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return ok(self._updates[:limit])
+
+    async def _get_file(self, params: dict):
+        entry = self._files.get(params.get('file_id'))
+        if entry is None:
+            return error(400, 'Bad Request: invalid file_id')
+        return ok({'file_id': params['file_id'], 'file_unique_id': params['file_id'],
+                   'file_size': entry['size'], 'file_path': params['file_id']})
+
+    async def _send_message(self, params: dict):
+        chat_id = int(params['chat_id'])
+        message = self._message(chat_id, BOT_USER, text=params.get('text', ''))
+        await self._record(chat_id, 'sendMessage', message)
+        return ok(message)
+
+    async def _edit_message_text(self, params: dict):
+        chat_id = int(params['chat_id'])
+        message = self._message(chat_id, BOT_USER, text=params.get('text', ''))
+        message['message_id'] = int(params['message_id'])
+        await self._record(chat_id, 'editMessageText', message)
+        return ok(message)
+
+    async def _send_media(self, params: dict):
+        """
+        sendVideo and sendAnimation: a new upload gets a file_id, a known file_id is sent again
+        """
+        chat_id = int(params['chat_id'])
+        media = params.get('video', params.get('animation'))
+        size = 0
+        if isinstance(media, web.FileField):
+            size = len(media.file.read())
+            self.uploaded_bytes += size
+            file_id = f'file{next(self._file_ids)}'
+            self._uploads.add(file_id)
+        elif media in self._uploads or media in self._files:
+            file_id = media
+        else:
+            return error(400, 'Bad Request: there is no video in the request')
+        key = 'video' if 'video' in params else 'animation'
+        message = self._message(chat_id, BOT_USER, caption=params.get('caption'),
+                                **{key: {'file_id': file_id, 'file_unique_id': file_id, 'width': 256,
+                                         'height': 256, 'duration': 0, 'file_size': size}})
+        await self._record(chat_id, 'sendVideo' if key == 'video' else 'sendAnimation', message,
+                           uploaded=size, file_id=file_id)
+        return ok(message)
+
@@ -0,0 +1,360 @@
+import itertools
+import logging
+import sys
+import time
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+
+import imageio
+import numpy as np
+import torch
+from skimage import img_as_ubyte
+
+from config import *
+from registry import get_models
+from workers import JobCancelled, check_cancelled, report_metrics, report_preview, report_progress
+
+sys.path.append("../first-order-model")
+from demo import iter_animation, iter_photo_animation, iter_frames, iter_video, read_video, resize_frame, \
+    auto_batch_size, detect_keypoints, iter_trajectory, kp_to_numpy, stack_trajectory, decimation_stride, decimate_kp, \
+    interpolate_frames
+from pipeline import Pipeline
+from upscale import get_upscaler
+from video_writer import FFmpegWriter, concat_videos
+from crop import crop_image, crop_video
+
+
+def probe_video(target: str, default_frames: int = 300):
+    """
+    Number of frames, fps and size of the video according to its metadata,
+    stride and rendered_frames - which and how many of the frames will be generated with RENDER_FPS
+    """
+    info = {'frames': default_frames, 'fps': 25.0, 'width': 256, 'height': 256}
+    try:
+        reader = imageio.get_reader(target)
+        meta = reader.get_meta_data()
+        reader.close()
+        info.update(frames=max(1, int(meta['duration'] * meta['fps'])), fps=meta['fps'])
+        info['width'], info['height'] = meta['size']
+    except Exception as e:
+        logging.warning(e)
+    info['stride'] = decimation_stride(info['fps'], RENDER_FPS)
+    info['rendered_frames'] = (info['frames'] + info['stride'] - 1) // info['stride']
+    return info
+
+
+def prepare_source(source: str, crop: bool = True):
+    """
+    Crop and read the source photo/video, returns frames and photo flag.
+    crop=False reads the source cropped before.
+    """
+    if crop:
+        if source.endswith('.jpg'):
+            crop_image(source)
+        else:
+            crop_video(source)
+    try:
+        source_reader = imageio.get_reader('crop_' + source)
+    except FileNotFoundError:
+        print("Didn't find cropped video")
+        source_reader = imageio.get_reader(source)
+
+    # Only the first frame of a photo is read, the reader is closed here and not when the generator is collected
+    with source_reader:
+        if source.endswith('.jpg'):
+            return next(iter_frames(source_reader)), True
+        return read_video(source_reader), False
+
+
+def prepare_target(target: str):
+    """
+    Crop the target video and open it for streaming, returns reader, fps and expected number of frames
+    """
+    crop_video(target)
+    try:
+        target_reader = imageio.get_reader('crop_' + target)
+    except FileNotFoundError:
+        print("Didn't find cropped video")
+        target_reader = imageio.get_reader(target)
+    meta = target_reader.get_meta_data()
+    return target_reader, meta['fps'], max(1, int(meta['duration'] * meta['fps']))
+
+
+def load_trajectory(path: str):
+    """
+    Keypoint trajectory of a target saved by save_trajectory, None if it can't be read
+    """
+    try:
+        with np.load(path) as f:
+            return {k: f[k] for k in f.files}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Can't load trajectory {path}: {e}")
+        return None
+
+
+def save_trajectory(path: str, trajectory: dict, fps: float):
+    np.savez(path, fps=fps, **trajectory)
+
+
+def prepare_data(source: str, target: str, trajectory: tp.Optional[dict] = None, crop_source: bool = True):
+    """
+    With a precomputed trajectory the target doesn't need to be cropped and decoded at all
+    """
+    data = dict()
+    data['trajectory'] = trajectory
+
+    # Source and target are cropped at the same time
+    with ThreadPoolExecutor(2) as executor:
+        source_future = executor.submit(prepare_source, source, crop_source)
+        if trajectory is None:
+            target_future = executor.submit(prepare_target, target)
+            data['target_reader'], data['fps'], data['num_frames'] = target_future.result()
+        else:
+            data['fps'], data['num_frames'] = float(trajectory['fps']), len(trajectory['value'])
+        data['source_media'], data['photo'] = source_future.result()
+
+    generator, kp_detector = get_models(config_path=CONFIG,
+                                        checkpoint_path=CHECKPOINT,
+                                        cpu=CPU, backend=BACKEND, onnx_dir=ONNX_DIR or None)
+    data['generator'] = generator
+    data['kp_detector'] = kp_detector
+    return data
+
+
+def first_order(source: str, target: str, filename: str, trajectory_path: tp.Optional[str] = None,
+                trajectory_out: tp.Optional[str] = None, sr_tier: tp.Optional[str] = None,
+                preview_path: tp.Optional[str] = None, chunk: tp.Optional[tp.Tuple[int, int]] = None,
+                stats: tp.Optional[dict] = None):
+    """
+    trajectory_path - cached keypoints of the target, trajectory_out - where to save them if they are computed,
+    sr_tier - super resolution tier instead of SR_TIER,
+    preview_path - where to write a short 256px preview, which is reported as soon as it is ready,
+    chunk - render only frames [start, stop) of the trajectory of a photo animation into filename.mp4
+    without sound (see prepare_chunks),
+    stats - filled with busy seconds of every stage, the number of written frames and of repeated ones
+    """
+    stats = stats if stats is not None else dict()
+    stages = stats.setdefault('stages', dict())
+    start = time.perf_counter()
+    trajectory = load_trajectory(trajectory_path) if trajectory_path is not None else None
+    if chunk is not None and trajectory is None:
+        raise ValueError("A chunk can be rendered only from a trajectory")
+    data = prepare_data(source, target, trajectory, crop_source=chunk is None)
+    stages['crop'] = time.perf_counter() - start
+    check_cancelled()
+    if chunk is not None and not data['photo']:
+        # The choice of the source frame of a video depends on all previous frames
+        raise ValueError("Only a photo animation can be rendered by chunks")
+    animation = iter_photo_animation if data['photo'] else iter_animation
+    batch_size = BATCH_SIZE or auto_batch_size(cpu=CPU)
+    recorded = []
+    # Keypoints are detected for every frame (so the trajectory stays reusable), but only every stride-th frame
+    # is generated, the frames in between are interpolated after super resolution
+    stride = decimation_stride(data['fps'], RENDER_FPS)
+    render_fps = data['fps'] / stride
+    if trajectory is not None:
+        total_frames = len(trajectory['value'])
+    else:
+        total_frames = lambda: sum(len(kp['value']) for kp in recorded)
+    kp_initial = dict()
+    if chunk is not None:
+        # Keyframes of the chunk and the first keyframe of the next one, which is needed for interpolation.
+        # Motion is relative to the first frame of the whole video, as in the sequential rendering
+        first, stop = chunk
+        keyframes = list(range(first, min(stop + 1, total_frames) if stride > 1 else stop, stride))
+        kp_initial['kp_driving_initial'] = {k: torch.tensor(trajectory[k][:1]) for k in ('value', 'jacobian')
+                                            if k in trajectory}
+        if not CPU:
+            kp_initial['kp_driving_initial'] = {k: v.cuda() for k, v in kp_initial['kp_driving_initial'].items()}
+        trajectory = {k: trajectory[k][keyframes] for k in ('value', 'jacobian') if k in trajectory}
+        total_frames = stop - first
+
+    def decode(frames):
+        return map(resize_frame, frames)
+
+    def keypoints(frames):
+        for kp in detect_keypoints(frames, data['kp_detector'], cpu=CPU, batch_size=batch_size):
+            recorded.append(kp_to_numpy(kp))
+            yield kp
+
+    # Near-static frames of a photo animation repeat the previous prediction,
+    # a video source is searched for the nearest frame within SOURCE_WINDOW frames
+    if data['photo']:
+        options = {'reuse_threshold': REUSE_THRESHOLD or None, 'stats': stats}
+    else:
+        options = {'window': SOURCE_WINDOW or None}
+
+    def generate(driving_kp):
+        if chunk is not None:
+            num_frames = len(trajectory['value'])
+        else:
+            num_frames = (data['num_frames'] + stride - 1) // stride
+            if stride > 1:
+                driving_kp = decimate_kp(driving_kp, stride, batch_size)
+        return animation(data['source_media'], None,
+                         data['generator'], data['kp_detector'],
+                         relative=RELATIVE,
+                         adapt_movement_scale=ADAPT_SCALE,
+                         cpu=CPU,
+                         progress_callback=report_progress,
+                         num_frames=num_frames,
+                         driving_kp=driving_kp,
+                         batch_size=batch_size,
+                         **options, **kp_initial)
+
+    def preview(frames):
+        # The first PREVIEW_SECONDS of generated frames are also written without super resolution and audio
+        limit = max(1, int(PREVIEW_SECONDS * render_fps))
+        preview_writer = FFmpegWriter(preview_path, render_fps / PREVIEW_STRIDE, codec=VIDEO_CODEC,
+                                      preset='ultrafast', crf=VIDEO_CRF, pix_fmt=VIDEO_PIX_FMT)
+        done = False
+        try:
+            for i, frame in enumerate(frames):
+                frame = img_as_ubyte(frame)
+                if not done and i < limit and i % PREVIEW_STRIDE == 0:
+                    preview_writer.append_data(frame)
+                if not done and i + 1 >= limit:
+                    preview_writer.close()
+                    report_preview(preview_path)
+                    done = True
+                yield frame
+            if not done and preview_writer.frames:
+                # The whole video is shorter than the preview
+                preview_writer.close()
+                report_preview(preview_path)
+        except BaseException:
+            if not done:
+                preview_writer.abort()
+            raise
+
+    upscaler = get_upscaler(sr_tier or SR_TIER, SR_SCALE, threads=SR_THREADS)
+
+    def upscale(frames):
+        return upscaler.iter_upscale(map(img_as_ubyte, frames))
+
+    def interpolate(frames):
+        # A chunk has one extra keyframe at the end, it belongs to the next chunk
+        frames = interpolate_frames(frames, stride, total_frames)
+        return itertools.islice(frames, total_frames) if chunk is not None else frames
+
+    # Decoding, generation, super resolution and encoding of different frames run at the same time
+    pipeline = Pipeline(maxsize=PIPELINE_QUEUE_SIZE)
+    if trajectory is None:
+        pipeline.add(decode, 'decode').add(keypoints, 'kp_detection')
+        items = iter_video(data['target_reader'])
+    else:
+        items = iter_trajectory(trajectory, cpu=CPU, batch_size=batch_size)
+    pipeline.add(generate, 'generation')
+    if preview_path is not None:
+        pipeline.add(preview, 'preview')
+    pipeline.add(upscale, 'sr')
+    if stride > 1:
+        pipeline.add(interpolate, 'interpolation')
+    # The sound of the target is copied into the result by the same ffmpeg process, chunks get it when joined
+    if chunk is None:
+        writer = FFmpegWriter(filename + '_a.mp4', data['fps'], audio_source=target, codec=VIDEO_CODEC,
+                              preset=VIDEO_PRESET, crf=VIDEO_CRF, pix_fmt=VIDEO_PIX_FMT)
+    else:
+        writer = FFmpegWriter(filename + '.mp4', data['fps'], codec=VIDEO_CODEC,
+                              preset=VIDEO_PRESET, crf=VIDEO_CRF, pix_fmt=VIDEO_PIX_FMT)
+    try:
+        with writer:
+            pipeline.run(items, writer.append_data, sink_name='encode')
+            start = time.perf_counter()
+        stages['mux'] = time.perf_counter() - start
+    finally:
+        stages.update(pipeline.timings)
+        stats['frames'] = writer.frames
+    check_cancelled()
+    if chunk is None and trajectory is None and trajectory_out is not None and recorded:
+        save_trajectory(trajectory_out, stack_trajectory(recorded), data['fps'])
+
+
+def safe_first_order(source: str, target: str, filename: str, trajectory_path: tp.Optional[str] = None,
+                     trajectory_out: tp.Optional[str] = None, sr_tier: tp.Optional[str] = None,
+                     preview_path: tp.Optional[str] = None, chunk: tp.Optional[tp.Tuple[int, int]] = None):
+    """
+    Safe run of first_order - errors are logged and reported as False
+    """
+    start = time.time()
+    stats = dict()
+    try:
+        first_order(source, target, filename, trajectory_path, trajectory_out, sr_tier, preview_path, chunk, stats)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print(e)
+        logging.warning(e)
+        return False
+    finally:
+        report_metrics(**stats)
+    end = time.time()
+    logging.info(f"Video processing took {end - start}")
+    return True
+
+
+def chunk_ranges(num_frames: int, parts: int, stride: int = 1):
+    """
+    Split frames into up to `parts` consecutive ranges [start, stop) of similar length,
+    every range starts with a generated frame (a multiple of stride)
+    """
+    keyframes = (num_frames + stride - 1) // stride
+    parts = max(1, min(parts, keyframes))
+    bounds = [round(i * keyframes / parts) * stride for i in range(parts)] + [num_frames]
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if start < stop]
+
+
+def prepare_chunks(source: str, target: str, trajectory_path: tp.Optional[str] = None,
+                   trajectory_out: tp.Optional[str] = None):
+    """
+    First step of the chunk-parallel rendering: crop the source and compute the trajectory of the target
+    (unless it is cached), so the chunks need neither of them. Returns the path and the number of frames
+    of the trajectory, None if something failed.
+    """
+    stats = {'stages': dict()}
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(2) as executor:
+            source_future = executor.submit(prepare_source, source)
+            if trajectory_path is None:
+                target_reader, fps, _ = executor.submit(prepare_target, target).result()
+            source_future.result()
+        stats['stages']['crop'] = time.perf_counter() - start
+        check_cancelled()
+
+        if trajectory_path is None:
+            _, kp_detector = get_models(config_path=CONFIG, checkpoint_path=CHECKPOINT, cpu=CPU, backend=BACKEND,
+                                        onnx_dir=ONNX_DIR or None)
+            batch_size = BATCH_SIZE or auto_batch_size(cpu=CPU)
+            recorded = []
+            pipeline = Pipeline(maxsize=PIPELINE_QUEUE_SIZE)
+            pipeline.add(lambda frames: map(resize_frame, frames), 'decode')
+            pipeline.add(lambda frames: detect_keypoints(frames, kp_detector, cpu=CPU, batch_size=batch_size),
+                         'kp_detection')
+            try:
+                pipeline.run(iter_video(target_reader), lambda kp: recorded.append(kp_to_numpy(kp)))
+            finally:
+                stats['stages'].update(pipeline.timings)
+                stats['stages'].pop('sink', None)
+            check_cancelled()
+            save_trajectory(trajectory_out, stack_trajectory(recorded), fps)
+            trajectory_path = trajectory_out
+
+        trajectory = load_trajectory(trajectory_path)
+        if trajectory is None:
+            return None
+        return {'trajectory': trajectory_path, 'frames': len(trajectory['value'])}
+    except JobCancelled:
+        raise
+    except Exception as e:
+        logging.warning(e)
+        return None
+    finally:
+        report_metrics(**stats)
+
+
+def join_chunks(paths: tp.Sequence[str], filename: str, target: str):
+    """
+    Join the chunks rendered by first_order into filename_a.mp4 with the sound of the target
+    """
+    concat_videos(paths, filename + '_a.mp4', audio_source=target)
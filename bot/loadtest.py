@@ -0,0 +1,238 @@
+"""
+Load test of the bot without Telegram: the bot polls the local fake Bot API server,
+simulated users upload a target video and then a source photo or video at the given rate.
+
+    python loadtest.py --targets ../videos/target.mp4 --sources img.jpg face.mp4 --users 50 --rate 0.2
+
+Reports throughput, latency percentiles of every stage of the dialog and the error rate.
+"""
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import typing as tp
+from argparse import ArgumentParser
+
+import cv2
+
+from fake_telegram import FakeTelegram, TOKEN
+
+# Replies of the bot that don't end the dialog, any other text is an error
+NOTICES = ('Видео успешно загружено', 'Фото успешно загружено', 'Начал обработку видео',
+           'Задача поставлена в очередь', 'Сейчас высокая нагрузка', '⏳')
+ASK_SOURCE = 'А теперь загрузи'
+STAGES = ('target_ack', 'source_ack', 'queued', 'preview', 'result')
+
+
+def probe(path: str):
+    """
+    Telegram metadata of a media file: photo or video with its size and duration
+    """
+    if path.lower().endswith(('.jpg', '.jpeg', '.png')):
+        image = cv2.imread(path)
+        if image is None:
+            raise ValueError(f"Can't read {path}")
+        return {'path': path, 'photo': True, 'width': image.shape[1], 'height': image.shape[0]}
+    capture = cv2.VideoCapture(path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    media = {'path': path, 'photo': False, 'width': int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+             'height': int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+             'duration': int(round(capture.get(cv2.CAP_PROP_FRAME_COUNT) / fps))}
+    capture.release()
+    if not media['width']:
+        raise ValueError(f"Can't read {path}")
+    return media
+
+
+def percentile(values, q: float):
+    """
+    Nearest-rank percentile
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+async def send(server: FakeTelegram, user_id: int, media: dict):
+    if media['photo']:
+        await server.send_photo(user_id, media['path'], media['width'], media['height'])
+    else:
+        await server.send_video(user_id, media['path'], media['width'], media['height'], media['duration'])
+
+
+async def run_user(server: FakeTelegram, user_id: int, target: dict, source: dict, timeout: float):
+    """
+    One dialog: target video, the request for a source, the source and everything the bot replies until the result.
+    Returns stage latencies in seconds, the status ('done' or the error) and whether the result was cached.
+    """
+    record = {'user_id': user_id, 'target': target['path'], 'source': source['path'], 'stages': dict()}
+    deadline = time.time() + timeout
+    index = 0
+
+    async def next_call():
+        nonlocal index
+        call = await server.wait_sent(user_id, index, max(0.0, deadline - time.time()))
+        index += 1
+        return call
+
+    start = time.time()
+    await send(server, user_id, target)
+    while True:
+        call = await next_call()
+        if call is None:
+            return dict(record, status='timeout')
+        text = call['message'].get('text') or ''
+        if text.startswith(ASK_SOURCE):
+            record['stages']['target_ack'] = call['time'] - start
+            break
+        if call['method'] == 'sendMessage' and not text.startswith(NOTICES):
+            return dict(record, status=text.splitlines()[0][:60])
+
+    start = time.time()
+    await send(server, user_id, source)
+    while True:
+        call = await next_call()
+        if call is None:
+            return dict(record, status='timeout')
+        text = call['message'].get('text') or ''
+        if call['method'] == 'sendVideo':
+            record['stages']['result'] = call['time'] - start
+            record['cached'] = 'queued' not in record['stages']
+            return dict(record, status='done')
+        if call['method'] == 'sendAnimation':
+            record['stages'].setdefault('preview', call['time'] - start)
+        elif call['method'] == 'sendMessage':
+            if text.startswith('Начал обработку'):
+                record['stages']['source_ack'] = call['time'] - start
+            elif text.startswith('Задача поставлена'):
+                record['stages']['queued'] = call['time'] - start
+            elif not text.startswith(NOTICES):
+                return dict(record, status=text.splitlines()[0][:60])
+
+
+def report(records, elapsed: float, uploaded_bytes: int):
+    done = [record for record in records if record['status'] == 'done']
+    errors = collections.Counter(record['status'] for record in records if record['status'] != 'done')
+    summary = {'users': len(records), 'done': len(done), 'cached': sum(record['cached'] for record in done),
+               'errors': dict(errors), 'error_rate': 1 - len(done) / max(1, len(records)),
+               'elapsed': elapsed, 'throughput': len(done) / elapsed if elapsed > 0 else 0.0,
+               'uploaded_bytes': uploaded_bytes, 'stages': dict()}
+    for stage in STAGES:
+        values = [record['stages'][stage] for record in records if stage in record['stages']]
+        if values:
+            summary['stages'][stage] = {'count': len(values), 'p50': percentile(values, 50),
+                                        'p95': percentile(values, 95), 'p99': percentile(values, 99)}
+    return summary
+
+
+def print_report(summary: dict):
+    print(f"Users: {summary['users']}, done: {summary['done']} ({summary['cached']} from cache), "
+          f"errors: {summary['error_rate']:.1%}")
+    print(f"Throughput: {summary['throughput']:.3f} results/s over {summary['elapsed']:.1f} s")
+    print(f"{'stage':<12}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, values in summary['stages'].items():
+        print(f"{stage:<12}{values['count']:>8}{values['p50']:>10.2f}{values['p95']:>10.2f}{values['p99']:>10.2f}")
+    for status, count in sorted(summary['errors'].items(), key=lambda item: -item[1]):
+        print(f"{count:>6}  {status}")
+
+
+def start_bot(url: str, log_path: str):
+    env = dict(os.environ, TOKEN=TOKEN, TELEGRAM_API=url)
+    log = open(log_path, 'a')
+    logging.info(f"Starting the bot, its log is {log_path}")
+    return subprocess.Popen([sys.executable, 'bot.py'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_bot(process: subprocess.Popen, timeout: float = 60):
+    # SIGINT lets aiogram run on_shutdown and stop the workers
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def wait_polling(server: FakeTelegram, process: tp.Optional[subprocess.Popen], timeout: float):
+    """
+    The bot polls only after every worker has loaded its models
+    """
+    deadline = time.time() + timeout
+    while not server.polling.is_set():
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"The bot exited with code {process.returncode} before polling")
+        if time.time() > deadline:
+            raise TimeoutError(f"The bot didn't start polling in {timeout} s")
+        try:
+            await asyncio.wait_for(server.polling.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def main(opt):
+    targets = [probe(path) for path in opt.targets]
+    sources = [probe(path) for path in opt.sources]
+    photos = [media for media in sources if media['photo']] or sources
+    videos = [media for media in sources if not media['photo']] or sources
+    rng = random.Random(opt.seed)
+
+    server = FakeTelegram()
+    runner = await server.serve(opt.host, opt.port)
+    url = f'http://{opt.host}:{opt.port}'
+    process = start_bot(url, opt.bot_log) if opt.spawn_bot else None
+    if process is None:
+        print(f"Start the bot with TELEGRAM_API={url} TOKEN={TOKEN}")
+    try:
+        await wait_polling(server, process, opt.startup_timeout)
+        logging.info(f"Bot is polling, {opt.users} users at {opt.rate} per second")
+
+        tasks = []
+        start = time.time()
+        for i in range(opt.users):
+            target = rng.choice(targets)
+            source = rng.choice(photos if rng.random() < opt.photo_share else videos)
+            tasks.append(asyncio.ensure_future(run_user(server, opt.first_user + i, target, source, opt.timeout)))
+            # Poisson arrivals
+            await asyncio.sleep(rng.expovariate(opt.rate))
+        records = await asyncio.gather(*tasks)
+        elapsed = time.time() - start
+    finally:
+        if process is not None:
+            stop_bot(process)
+        await runner.cleanup()
+
+    summary = report(records, elapsed, server.uploaded_bytes)
+    print_report(summary)
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump({'summary': summary, 'users': records}, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--targets", nargs='+', required=True, help="target videos to pick from")
+    parser.add_argument("--sources", nargs='+', required=True, help="source photos (.jpg/.png) and videos to pick from")
+    parser.add_argument("--photo_share", type=float, default=0.5, help="share of users with a photo source")
+    parser.add_argument("--users", type=int, default=20, help="number of simulated users")
+    parser.add_argument("--rate", type=float, default=0.1, help="new users per second")
+    parser.add_argument("--timeout", type=float, default=1200, help="seconds for the dialog of one user")
+    parser.add_argument("--first_user", type=int, default=10000, help="user id of the first user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--no_spawn", dest="spawn_bot", action="store_false",
+                        help="don't start bot.py, wait for an already configured one")
+    parser.add_argument("--startup_timeout", type=float, default=600, help="seconds for the bot to start polling")
+    parser.add_argument("--bot_log", default='logs/loadtest_bot.log')
+    parser.add_argument("--output", default=None, help="JSON file for the summary and every user")
+    opt = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s', level=logging.INFO)
+    os.makedirs(os.path.dirname(opt.bot_log) or '.', exist_ok=True)
+    asyncio.run(main(opt))
@@ -0,0 +1,161 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import typing as tp
+
+from aiohttp import web
+
+# Seconds, from a quick crop to a minute-long video
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+FPS_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50)
+RSS_BUCKETS = tuple(2 ** i * 1024 ** 2 for i in range(8, 16))
+
+
+class Histogram:
+    def __init__(self, buckets: tp.Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: dict, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    """
+    Histograms, counters and gauges of the bot, rendered in the Prometheus text format.
+    Gauges are functions evaluated at every scrape.
+    """
+
+    def __init__(self, prefix: str = 'face2face'):
+        self.prefix = prefix
+        self._histograms = dict()
+        self._counters = dict()
+        self._gauges = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, buckets: tp.Sequence[float] = TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, fn: tp.Callable[[], float]):
+        self._gauges[name] = fn
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                name = f'{self.prefix}_{name}'
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                labels = dict(labels)
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{name}_bucket{_labels(labels, le=bound)} {count}')
+                lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+            for (name, labels), value in sorted(self._counters.items()):
+                name = f'{self.prefix}_{name}'
+                if name not in typed:
+                    lines.append(f'# TYPE {name} counter')
+                    typed.add(name)
+                lines.append(f'{name}{_labels(dict(labels))} {value}')
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                logging.warning(f"Gauge {name} failed: {e}")
+                continue
+            lines.append(f'# TYPE {self.prefix}_{name} gauge')
+            lines.append(f'{self.prefix}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def observe_job(self, stats: dict):
+        """
+        Record the stats of a finished job collected by the scheduler and the worker
+        """
+        for stage, seconds in stats.get('stages', dict()).items():
+            self.observe('stage_seconds', seconds, stage=stage)
+        if 'queue_wait' in stats:
+            self.observe('queue_wait_seconds', stats['queue_wait'])
+        if stats.get('fps'):
+            self.observe('job_fps', stats['fps'], buckets=FPS_BUCKETS)
+        if stats.get('peak_rss'):
+            self.observe('job_peak_rss_bytes', stats['peak_rss'], buckets=RSS_BUCKETS)
+        if stats.get('skipped_frames'):
+            self.inc('frames_skipped_total', stats['skipped_frames'])
+        self.inc('jobs_total', status=stats.get('status', 'unknown'))
+
+    async def serve(self, host: str, port: int):
+        """
+        Start the /metrics endpoint in the running event loop
+        """
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError:
+            await runner.cleanup()
+            raise
+        logging.info(f"Metrics are served at http://{host}:{port}/metrics")
+        return runner
+
+
+class JobLedger:
+    """
+    One JSON line per finished job
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, record: dict):
+        line = json.dumps(dict(record, time=time.time()), default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+metrics = Metrics()
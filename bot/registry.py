@@ -0,0 +1,88 @@
+import logging
+import os
+import sys
+import threading
+import typing as tp
+
+import torch
+
+sys.path.append("../first-order-model")
+from backends import load_models, check_parity
+
+
+class ModelRegistry:
+    """
+    Process-wide storage of loaded models.
+    Every (config, checkpoint, device, backend) is loaded and warmed up once and then shared by all jobs.
+    ONNX models are compared with torch after loading, the torch backend is used if they differ or can't be loaded.
+    """
+
+    def __init__(self):
+        self._models = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(config_path: str, checkpoint_path: str, cpu: bool, backend: str = 'torch',
+                 onnx_dir: tp.Optional[str] = None):
+        onnx_dir = os.path.abspath(onnx_dir) if onnx_dir is not None and backend != 'torch' else None
+        return os.path.abspath(config_path), os.path.abspath(checkpoint_path), 'cpu' if cpu else 'cuda', backend, \
+            onnx_dir
+
+    def get(self, config_path: str, checkpoint_path: str, cpu: bool = False, warmup: bool = True,
+            backend: str = 'torch', onnx_dir: tp.Optional[str] = None):
+        """
+        Return (generator, kp_detector) in eval mode, loading them on the first request
+        """
+        key = self.make_key(config_path, checkpoint_path, cpu, backend, onnx_dir)
+        # One lock for all keys: concurrent first requests must not read the checkpoint several times
+        with self._lock:
+            if key not in self._models:
+                logging.info(f"Loading models for {key}")
+                generator, kp_detector = self.load(config_path, checkpoint_path, cpu, backend, onnx_dir)
+                if warmup:
+                    self.warmup(generator, kp_detector, cpu=cpu)
+                self._models[key] = (generator, kp_detector)
+        return self._models[key]
+
+    @staticmethod
+    def load(config_path: str, checkpoint_path: str, cpu: bool, backend: str, onnx_dir: tp.Optional[str]):
+        torch_models = load_models(config_path, checkpoint_path, cpu=cpu)
+        if backend == 'torch':
+            logging.info("Using backend torch")
+            return torch_models
+        try:
+            models = load_models(config_path, checkpoint_path, cpu=cpu, backend=backend, onnx_dir=onnx_dir)
+            differences = check_parity(torch_models, models)
+        except (ImportError, OSError, ValueError, RuntimeError) as e:
+            logging.error(f"Backend {backend} is not usable, falling back to torch: {e!r}")
+            logging.info("Using backend torch")
+            return torch_models
+        logging.info(f"Using backend {backend}, it matches torch, max differences {differences}")
+        return models
+
+    @staticmethod
+    def warmup(generator, kp_detector, cpu: bool = False, frame_shape=(256, 256)):
+        """
+        Run a single forward pass so that lazy allocations happen before the first real job
+        """
+        with torch.no_grad():
+            frame = torch.zeros(1, 3, *frame_shape)
+            if not cpu:
+                frame = frame.cuda()
+            kp = kp_detector(frame)
+            generator(frame, kp_source=kp, kp_driving=kp)
+
+    def loaded(self):
+        return list(self._models.keys())
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+registry = ModelRegistry()
+
+
+def get_models(config_path: str, checkpoint_path: str, cpu: bool = False, backend: str = 'torch',
+               onnx_dir: tp.Optional[str] = None):
+    return registry.get(config_path, checkpoint_path, cpu=cpu, backend=backend, onnx_dir=onnx_dir)
@@ -0,0 +1,299 @@
+import asyncio
+import collections
+import logging
+import time
+import typing as tp
+
+from workers import InferencePool, JobCancelled
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    """
+    Queued or running user request
+    """
+
+    def __init__(self, user_id: int, fn: tp.Callable, args: tuple, frames: int,
+                 on_update: tp.Optional[tp.Callable] = None, stats: tp.Optional[dict] = None,
+                 not_before: float = 0, on_preview: tp.Optional[tp.Callable] = None):
+        self.user_id = user_id
+        self.fn = fn
+        self.args = args
+        self.frames = max(1, frames)
+        self.on_update = on_update
+        self.on_preview = on_preview
+        self.future = asyncio.get_running_loop().create_future()
+        self.pool_id = None
+        self.done_frames = 0
+        self.cancelled = False
+        self.submitted = time.time()
+        # Admission control may hold the job until the CPU budget allows it
+        self.not_before = not_before
+        self.started = None
+        # Filled by the scheduler and the worker: queue_wait, run_seconds, stages, frames, fps, peak_rss
+        self.stats = stats if stats is not None else dict()
+
+    def remaining_frames(self):
+        return self.frames - self.done_frames
+
+
+def merge_stats(parts: tp.Sequence[dict]):
+    """
+    Stats of a request executed as several jobs: times and counts are summed, peak memory is the largest one
+    """
+    stats = {'stages': collections.Counter()}
+    for part in parts:
+        stats['stages'].update(part.get('stages', dict()))
+        for key in ('frames', 'skipped_frames', 'cpu_seconds'):
+            if key in part:
+                stats[key] = stats.get(key, 0) + part[key]
+        if 'peak_rss' in part:
+            stats['peak_rss'] = max(stats.get('peak_rss', 0), part['peak_rss'])
+    stats['stages'] = dict(stats['stages'])
+    started = [part for part in parts if 'run_seconds' in part]
+    if started:
+        stats['queue_wait'] = min(part['queue_wait'] for part in started)
+        stats['run_seconds'] = max(part['queue_wait'] + part['run_seconds'] for part in started) - stats['queue_wait']
+        if stats.get('frames'):
+            stats['fps'] = stats['frames'] / stats['run_seconds']
+    return stats
+
+
+class JobScheduler:
+    """
+    Bounded job queue in front of the inference pool.
+    Users are served round-robin, so a user with many requests can't block the others.
+    A new job of a user cancels the previous one, queued or running.
+    """
+
+    def __init__(self, pool: InferencePool, max_queued: int = 20, sec_per_frame: float = 0.5,
+                 update_interval: float = 5, smoothing: float = 0.2):
+        self.pool = pool
+        self.max_queued = max_queued
+        self.update_interval = update_interval
+        self.smoothing = smoothing
+        # Measured throughput, updated by every progress report
+        self.sec_per_frame = sec_per_frame
+        self._queues = collections.OrderedDict()
+        self._running = set()
+        self._wakeup = None
+        self._tasks = []
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._dispatch()) for _ in range(self.pool.num_workers)]
+        self._tasks.append(asyncio.ensure_future(self._notify_loop()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def submit(self, user_id: int, fn: tp.Callable, *args, frames: int = 1,
+                     on_update: tp.Optional[tp.Callable] = None, stats: tp.Optional[dict] = None,
+                     delay: float = 0, on_preview: tp.Optional[tp.Callable] = None):
+        """
+        Queue fn(*args) for the user and wait for its result.
+        on_update(position, eta) is awaited when the job's position or ETA changes, position 0 means running.
+        stats (if given) is filled with the metrics of the job.
+        The job is not dispatched earlier than `delay` seconds from now, other users' jobs may overtake it.
+        on_preview(path) is awaited when the job has written a preview of its result.
+        Raises QueueFull if the queue is full and JobCancelled if the job was replaced by a newer one.
+        """
+        self.cancel(user_id)
+        if self.queued() >= self.max_queued:
+            raise QueueFull(f"{self.queued()} jobs are already queued")
+
+        job = Job(user_id, fn, args, frames, on_update, stats, not_before=time.time() + delay,
+                  on_preview=on_preview)
+        self._queues.setdefault(user_id, collections.deque()).append(job)
+        self._wakeup.set()
+        await self._notify(job)
+        return await job.future
+
+    async def submit_group(self, user_id: int, calls: tp.Sequence[tp.Tuple[tp.Callable, tuple]],
+                           frames: tp.Sequence[int], on_update: tp.Optional[tp.Callable] = None,
+                           stats: tp.Optional[dict] = None, on_preview: tp.Optional[tp.Callable] = None,
+                           accept: tp.Optional[tp.Callable] = None):
+        """
+        Queue parts of one request (fn, args), e.g. chunks of a long video, which may run on several workers
+        at once, and wait for the list of their results. Parts are dispatched in order and take turns
+        with other users like separate jobs. If a part fails, the rest are cancelled: an error is raised again,
+        a result rejected by accept(result) gives None instead of the list.
+        on_update follows the last part, on_preview - the first one, stats gets the sum of the parts.
+        """
+        self.cancel(user_id)
+        if self.queued() + len(calls) > self.max_queued:
+            raise QueueFull(f"{self.queued()} jobs are already queued")
+
+        last = len(calls) - 1
+        jobs = [Job(user_id, fn, args, part_frames, on_update if i == last else None,
+                    on_preview=on_preview if i == 0 else None)
+                for i, ((fn, args), part_frames) in enumerate(zip(calls, frames))]
+        self._queues.setdefault(user_id, collections.deque()).extend(jobs)
+        self._wakeup.set()
+        await self._notify(jobs[-1])
+        try:
+            pending = {job.future for job in jobs}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if accept is not None and not accept(future.result()):
+                        logging.info(f"A part of the request of user {user_id} failed, cancelling the rest")
+                        self._abandon(jobs)
+                        return None
+            return [job.future.result() for job in jobs]
+        except BaseException:
+            self._abandon(jobs)
+            raise
+        finally:
+            if stats is not None:
+                stats.update(merge_stats([job.stats for job in jobs]))
+
+    def _abandon(self, jobs: tp.Sequence[Job]):
+        # Only these parts: the user may already have a newer request in the queue
+        self._cancel_jobs(jobs)
+        for job in jobs:
+            # The errors of the other parts are expected, they must not be reported as unretrieved
+            job.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    def cancel(self, user_id: int):
+        """
+        Drop queued jobs of the user and stop the running ones between frames
+        """
+        jobs = list(self._queues.get(user_id, [])) + [job for job in self._running if job.user_id == user_id]
+        self._cancel_jobs(jobs)
+
+    def _cancel_jobs(self, jobs: tp.Sequence[Job]):
+        for job in jobs:
+            queue = self._queues.get(job.user_id)
+            if queue is not None and job in queue:
+                queue.remove(job)
+                if not queue:
+                    del self._queues[job.user_id]
+                if not job.future.done():
+                    job.future.set_exception(JobCancelled(f"Job of user {job.user_id} was replaced"))
+            elif job in self._running and job.pool_id is not None and not job.cancelled:
+                logging.info(f"Cancelling running job of user {job.user_id}")
+                job.cancelled = True
+                self.pool.cancel(job.pool_id)
+
+    def running(self):
+        return len(self._running)
+
+    def order(self):
+        """
+        Queued jobs in the order they will be dispatched
+        """
+        queues = [list(queue) for queue in self._queues.values()]
+        jobs = []
+        for depth in range(max(map(len, queues), default=0)):
+            jobs += [queue[depth] for queue in queues if depth < len(queue)]
+        return jobs
+
+    def eta(self, job: Job):
+        """
+        Position of the job (0 if running) and estimated seconds until it is finished
+        """
+        if job in self._running:
+            return 0, job.remaining_frames() * self.sec_per_frame
+
+        order = self.order()
+        position = order.index(job) + 1
+        ahead = sum(j.remaining_frames() for j in self._running)
+        ahead += sum(j.frames for j in order[:position - 1])
+        wait = ahead * self.sec_per_frame / max(1, self.pool.num_workers)
+        wait = max(wait, job.not_before - time.time())
+        return position, wait + job.frames * self.sec_per_frame
+
+    def _next_job(self):
+        now = time.time()
+        for user_id, queue in list(self._queues.items()):
+            if not queue:
+                del self._queues[user_id]
+                continue
+            if queue[0].not_before > now:
+                continue
+            job = queue.popleft()
+            # The user goes to the end of the rotation
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            return job
+        return None
+
+    async def _dispatch(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                held = [queue[0].not_before for queue in self._queues.values() if queue]
+                try:
+                    timeout = max(0.0, min(held) - time.time()) if held else None
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job.started = time.time()
+            job.stats['queue_wait'] = job.started - job.submitted
+            self._running.add(job)
+            last = [job.started]
+
+            def on_progress(done, total, job=job, last=last):
+                now = time.time()
+                frames = done - job.done_frames
+                # The first report also includes preprocessing time, so it doesn't count
+                if frames > 0 and job.done_frames > 0:
+                    per_frame = (now - last[0]) / frames
+                    self.sec_per_frame += self.smoothing * (per_frame - self.sec_per_frame)
+                last[0] = now
+                job.frames = total
+                job.done_frames = done
+
+            def on_preview(path, job=job):
+                if job.on_preview is not None and not job.future.done() and not job.cancelled:
+                    asyncio.ensure_future(self._preview(job, path))
+
+            job.pool_id, future = self.pool.enqueue(job.fn, *job.args, on_progress=on_progress,
+                                                    on_metrics=job.stats.update, on_preview=on_preview)
+            await self._notify(job)
+            try:
+                result = await future
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                job.stats['run_seconds'] = time.time() - job.started
+                if job.stats.get('frames'):
+                    job.stats['fps'] = job.stats['frames'] / job.stats['run_seconds']
+                self._running.discard(job)
+
+    async def _preview(self, job: Job, path: str):
+        try:
+            await job.on_preview(path)
+        except Exception as e:
+            logging.warning(e)
+
+    async def _notify(self, job: Job):
+        if job.on_update is None or job.future.done():
+            return
+        try:
+            await job.on_update(*self.eta(job))
+        except Exception as e:
+            logging.warning(e)
+
+    async def _notify_loop(self):
+        while True:
+            await asyncio.sleep(self.update_interval)
+            for job in list(self._running) + self.order():
+                await self._notify(job)
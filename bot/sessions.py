@@ -0,0 +1,197 @@
+import abc
+import collections
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+import typing as tp
+import uuid
+
+JOB_NAME = re.compile(r'\d+_[0-9a-f]{8}')
+
+
+def job_crop_dir(job_dir: str):
+    """
+    crop.py writes the cropped copy of path to 'crop_' + path
+    """
+    return 'crop_' + job_dir
+
+
+def remove_job_files(job_dir: str):
+    for directory in (job_dir, job_crop_dir(job_dir)):
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class SessionStore(abc.ABC):
+    """
+    State of users between messages: uploaded source and target and the temp directory of the current job.
+    Sessions expire after `ttl` seconds without updates and the least recently updated ones are evicted
+    above `max_sessions`, their directories are removed with them.
+    A busy session (its job is being processed) is never evicted, its files belong to process_video.
+    Backends store sessions as plain dicts: _read, _write, _delete and _items.
+    """
+
+    def __init__(self, root: str, max_sessions: int = 1000, ttl: float = 3600):
+        self.root = root
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+
+    def get(self, user_id: int) -> tp.Optional[dict]:
+        session = self._read(user_id)
+        if session is not None and self._expired(session):
+            self._evict(user_id, session)
+            return None
+        return session
+
+    def new_job(self, user_id: int) -> dict:
+        """
+        Start a new job of the user in a fresh directory, the previous one is dropped
+        """
+        self.remove(user_id)
+        job = f'{user_id}_{uuid.uuid4().hex[:8]}'
+        session = {'user_id': user_id, 'job': job, 'dir': os.path.join(self.root, job, ''),
+                   'source': None, 'target': None, 'busy': False, 'updated': time.time()}
+        os.makedirs(session['dir'], exist_ok=True)
+        os.makedirs(job_crop_dir(session['dir']), exist_ok=True)
+        self._write(user_id, session)
+        self.expire()
+        return session
+
+    def update(self, user_id: int, **fields) -> tp.Optional[dict]:
+        session = self.get(user_id)
+        if session is None:
+            return None
+        session.update(fields, updated=time.time())
+        self._write(user_id, session)
+        return session
+
+    def remove(self, user_id: int):
+        session = self._read(user_id)
+        if session is not None:
+            self._evict(user_id, session)
+
+    def finish(self, user_id: int, session: dict):
+        """
+        Remove the files of a processed (or cancelled) job, and the session itself if it is still the current one
+        """
+        remove_job_files(session['dir'])
+        current = self._read(user_id)
+        if current is not None and current['job'] == session['job']:
+            self._delete(user_id)
+
+    def expire(self):
+        """
+        Drop expired sessions and the oldest ones above max_sessions
+        """
+        sessions = sorted(self._items(), key=lambda item: item[1]['updated'])
+        alive = []
+        for user_id, session in sessions:
+            if self._expired(session):
+                self._evict(user_id, session)
+            else:
+                alive.append((user_id, session))
+        for user_id, session in alive[:max(0, len(alive) - self.max_sessions)]:
+            if not session['busy']:
+                self._evict(user_id, session)
+
+    def recover(self):
+        """
+        After a restart no job is running anymore: their sessions become idle and expire as usual,
+        job directories left by the previous run without a session are removed
+        """
+        jobs = set()
+        for user_id, session in self._items():
+            jobs.add(session['job'])
+            if session['busy']:
+                session['busy'] = False
+                self._write(user_id, session)
+        for root in (self.root, job_crop_dir(self.root)):
+            if not os.path.isdir(root):
+                continue
+            for name in os.listdir(root):
+                if JOB_NAME.fullmatch(name) and name not in jobs:
+                    remove_job_files(os.path.join(self.root, name, ''))
+        logging.info(f"Recovered {len(jobs)} sessions")
+
+    def _expired(self, session: dict):
+        return not session['busy'] and time.time() - session['updated'] > self.ttl
+
+    def _evict(self, user_id: int, session: dict):
+        self._delete(user_id)
+        if not session['busy']:
+            remove_job_files(session['dir'])
+
+    def __len__(self):
+        return len(self._items())
+
+    @abc.abstractmethod
+    def _read(self, user_id: int) -> tp.Optional[dict]:
+        pass
+
+    @abc.abstractmethod
+    def _write(self, user_id: int, session: dict):
+        pass
+
+    @abc.abstractmethod
+    def _delete(self, user_id: int):
+        pass
+
+    @abc.abstractmethod
+    def _items(self) -> tp.List[tp.Tuple[int, dict]]:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, root: str, max_sessions: int = 1000, ttl: float = 3600):
+        super().__init__(root, max_sessions, ttl)
+        self._sessions = collections.OrderedDict()
+
+    def _read(self, user_id: int):
+        session = self._sessions.get(user_id)
+        return dict(session) if session is not None else None
+
+    def _write(self, user_id: int, session: dict):
+        self._sessions[user_id] = dict(session)
+
+    def _delete(self, user_id: int):
+        self._sessions.pop(user_id, None)
+
+    def _items(self):
+        return [(user_id, dict(session)) for user_id, session in self._sessions.items()]
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Sessions in a SQLite file, so uploaded media survive a restart of the bot
+    """
+
+    def __init__(self, path: str, root: str, max_sessions: int = 1000, ttl: float = 3600):
+        super().__init__(root, max_sessions, ttl)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self._db.commit()
+
+    def _read(self, user_id: int):
+        row = self._db.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _write(self, user_id: int, session: dict):
+        self._db.execute("INSERT OR REPLACE INTO sessions (user_id, data) VALUES (?, ?)",
+                         (user_id, json.dumps(session)))
+        self._db.commit()
+
+    def _delete(self, user_id: int):
+        self._db.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+        self._db.commit()
+
+    def _items(self):
+        return [(user_id, json.loads(data)) for user_id, data in self._db.execute("SELECT user_id, data FROM sessions")]
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,379 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import traceback
+import typing as tp
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# State of the job executed by the current worker process
+_current = {'job_id': None, 'worker_id': None, 'results': None, 'cancel_flags': None}
+
+
+def report_progress(done: int, total: int):
+    """
+    Report progress of the current job and stop it if it was cancelled.
+    Does nothing outside of a worker process.
+    """
+    if _current['job_id'] is None:
+        return
+    check_cancelled()
+    _current['results'].put(('progress', _current['job_id'], (done, total)))
+
+
+def report_metrics(**stats):
+    """
+    Send stats of the current job (stage timings, frames) to the main process
+    """
+    if _current['job_id'] is None:
+        return
+    _current['results'].put(('metrics', _current['job_id'], stats))
+
+
+def report_preview(path: str):
+    """
+    Tell the main process that a preview of the current job's result is written to path
+    """
+    if _current['job_id'] is None:
+        return
+    _current['results'].put(('preview', _current['job_id'], path))
+
+
+def check_cancelled():
+    if _current['job_id'] is None:
+        return
+    if _current['cancel_flags'][_current['worker_id']] == _current['job_id']:
+        raise JobCancelled(f"Job {_current['job_id']} was cancelled")
+
+
+def available_cpus():
+    """
+    CPUs the process is allowed to run on, a container or a cpuset may allow fewer than os.cpu_count()
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def worker_cpus(worker_id: int, threads: int, cpus: tp.Optional[tp.Sequence[int]] = None):
+    """
+    CPUs assigned to a worker: consecutive blocks of `threads` of the allowed CPUs, wrapping around
+    """
+    cpus = cpus or available_cpus()
+    return sorted({cpus[(worker_id * threads + i) % len(cpus)] for i in range(threads)})
+
+
+def _reset_peak_rss():
+    # Linux resets the VmHWM of the process after writing 5 to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Peak resident memory of the process in bytes, since the last reset if the kernel supports it
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _worker_loop(worker_id: int, tasks, results, cancel_flags, settings: dict):
+    """
+    Body of a worker process: pin itself, preload models and execute jobs from the task queue
+    """
+    threads = settings['torch_threads']
+    # Any error before the models are loaded must reach the main process, it waits for every worker
+    try:
+        if settings['pin_cpus'] and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, worker_cpus(worker_id, threads))
+
+        import torch
+        torch.set_num_threads(threads)
+
+        from registry import get_models
+        get_models(settings['config'], settings['checkpoint'], cpu=settings['cpu'], backend=settings['backend'],
+                   onnx_dir=settings['onnx_dir'])
+    except Exception as e:
+        results.put(('failed', worker_id, repr(e)))
+        return
+    results.put(('ready', worker_id, None))
+    _current.update(worker_id=worker_id, results=results, cancel_flags=cancel_flags)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_id, fn, args, kwargs = task
+        _current['job_id'] = job_id
+        results.put(('started', job_id, worker_id))
+        _reset_peak_rss()
+        times = os.times()
+        try:
+            check_cancelled()
+            result = ('done', job_id, fn(*args, **kwargs))
+        except JobCancelled:
+            result = ('cancelled', job_id, None)
+        except Exception as e:
+            logging.warning(traceback.format_exc())
+            result = ('error', job_id, repr(e))
+        # Metrics go first, so they are recorded before the job's future is resolved
+        # CPU time of all threads of the worker and of finished children (ffmpeg)
+        cpu_seconds = sum(os.times()[:4]) - sum(times[:4])
+        report_metrics(peak_rss=peak_rss(), cpu_seconds=cpu_seconds)
+        results.put(result)
+        _current['job_id'] = None
+
+
+class InferencePool:
+    """
+    Long-lived pool of worker processes with preloaded models.
+    Jobs are sent over a multiprocessing queue, results are awaited through asyncio futures.
+    """
+
+    def __init__(self, num_workers: int, config_path: str, checkpoint_path: str, cpu: bool = False,
+                 torch_threads: int = 1, pin_cpus: bool = False, backend: str = 'torch',
+                 onnx_dir: tp.Optional[str] = None):
+        self.num_workers = num_workers
+        self.settings = {
+            'config': config_path,
+            'checkpoint': checkpoint_path,
+            'cpu': cpu,
+            'torch_threads': torch_threads,
+            'pin_cpus': pin_cpus,
+            'backend': backend,
+            'onnx_dir': onnx_dir,
+        }
+        self._ctx = mp.get_context('spawn')
+        self._tasks = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        # cancel_flags[worker_id] == job_id asks the worker to stop that job
+        self._cancel_flags = self._ctx.Array('q', [-1] * num_workers)
+        self._processes = []
+        self._futures = dict()
+        self._progress = dict()
+        self._metrics = dict()
+        self._previews = dict()
+        self._workers = dict()
+        self._cancelled = set()
+        self._ids = itertools.count()
+        # worker_id -> 'ready' or 'failed', the pool is ready when every worker has a state
+        self._states = dict()
+        self._ready_event = threading.Event()
+        self._collector = None
+        self._closing = False
+
+    def start(self):
+        # A spawned worker imports the main module of the parent again before _worker_loop runs, and torch
+        # with it, so the thread limits must already be in the environment it inherits
+        os.environ['OMP_NUM_THREADS'] = str(self.settings['torch_threads'])
+        os.environ['MKL_NUM_THREADS'] = str(self.settings['torch_threads'])
+        self._processes = [None] * self.num_workers
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _spawn(self, worker_id: int):
+        process = self._ctx.Process(target=_worker_loop, daemon=True,
+                                    args=(worker_id, self._tasks, self._results, self._cancel_flags, self.settings))
+        process.start()
+        self._processes[worker_id] = process
+
+    async def wait_ready(self):
+        """
+        Wait until every worker has loaded its models or failed. A worker that exits without reporting
+        (killed, crashed in native code) is noticed by the collector through its exit code.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._ready_event.wait)
+        if 'ready' not in self._states.values():
+            raise RuntimeError("No inference worker could load the models")
+
+    def enqueue(self, fn: tp.Callable, *args, on_progress: tp.Optional[tp.Callable] = None,
+                on_metrics: tp.Optional[tp.Callable] = None, on_preview: tp.Optional[tp.Callable] = None,
+                **kwargs):
+        """
+        Send fn(*args, **kwargs) to the workers. fn must be importable by the worker (module level).
+        on_progress(done, total) is called in the event loop whenever the job reports progress,
+        on_metrics(stats) - whenever it reports metrics (see report_metrics),
+        on_preview(path) - when it reports a preview (see report_preview).
+        Returns job id and a future with the result.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        job_id = next(self._ids)
+        # Callbacks run in the context of the caller, e.g. with the current aiogram Bot set
+        self._futures[job_id] = (loop, future, contextvars.copy_context())
+        if on_progress is not None:
+            self._progress[job_id] = on_progress
+        if on_metrics is not None:
+            self._metrics[job_id] = on_metrics
+        if on_preview is not None:
+            self._previews[job_id] = on_preview
+        self._tasks.put((job_id, fn, args, kwargs))
+        return job_id, future
+
+    async def submit(self, fn: tp.Callable, *args, **kwargs):
+        _, future = self.enqueue(fn, *args, **kwargs)
+        return await future
+
+    def cancel(self, job_id: int):
+        """
+        Stop the job at its next progress report (or before start, if it is still queued)
+        """
+        self._cancelled.add(job_id)
+        worker_id = self._workers.get(job_id)
+        if worker_id is not None:
+            self._cancel_flags[worker_id] = job_id
+
+    def _set_state(self, worker_id: int, state: str):
+        self._states[worker_id] = state
+        if len(self._states) == self.num_workers:
+            self._ready_event.set()
+
+    def _check_workers(self):
+        """
+        A worker that died before loading the models counts as failed. A worker that died later (OOM killer,
+        a crash in native code) fails its running job and is started again.
+        """
+        dead = [worker_id for worker_id, process in enumerate(self._processes) if process.exitcode is not None]
+        if self._closing or not dead:
+            return True
+        # Everything a worker sent was written before it exited: the results of its last job go first
+        running = self._drain()
+        for worker_id in dead:
+            exitcode = self._processes[worker_id].exitcode
+            state = self._states.get(worker_id)
+            if state is None:
+                logging.warning(f"Worker {worker_id} exited with code {exitcode} before loading the models")
+                self._set_state(worker_id, 'failed')
+            elif state == 'ready':
+                logging.error(f"Worker {worker_id} died with code {exitcode}, starting it again")
+                for job_id in [job_id for job_id, owner in self._workers.items() if owner == worker_id]:
+                    self._finish(job_id, 'error', f"Worker {worker_id} died with code {exitcode}")
+                del self._states[worker_id]
+                self._cancel_flags[worker_id] = -1
+                self._spawn(worker_id)
+        return running
+
+    def _drain(self):
+        while True:
+            try:
+                message = self._results.get_nowait()
+            except queue.Empty:
+                return True
+            if not self._handle(message):
+                return False
+
+    def _collect(self):
+        checked = time.time()
+        running = True
+        while running:
+            try:
+                running = self._handle(self._results.get(timeout=1))
+            except queue.Empty:
+                pass
+            if running and time.time() - checked >= 1:
+                running = self._check_workers()
+                checked = time.time()
+
+    def _handle(self, message) -> bool:
+        """
+        Process a message of a worker, False for the stop message of shutdown
+        """
+        if message is None:
+            return False
+        kind, key, payload = message
+        if kind in ('ready', 'failed'):
+            if kind == 'ready':
+                logging.info(f"Worker {key} is ready")
+            else:
+                logging.warning(f"Worker {key} failed to start: {payload}")
+            self._set_state(key, kind)
+            return True
+        if key not in self._futures:
+            # A late message of a job that was failed when its worker died
+            return True
+        loop, future, context = self._futures[key]
+        if kind == 'started':
+            self._workers[key] = payload
+            if key in self._cancelled:
+                self._cancel_flags[payload] = key
+        elif kind == 'progress':
+            if key in self._progress:
+                loop.call_soon_threadsafe(self._progress[key], *payload, context=context)
+        elif kind == 'metrics':
+            if key in self._metrics:
+                loop.call_soon_threadsafe(self._metrics[key], payload, context=context)
+        elif kind == 'preview':
+            if key in self._previews:
+                loop.call_soon_threadsafe(self._previews[key], payload, context=context)
+        else:
+            self._finish(key, kind, payload)
+        return True
+
+    def _finish(self, job_id: int, kind: str, payload):
+        loop, future, _ = self._futures.pop(job_id)
+        self._progress.pop(job_id, None)
+        self._metrics.pop(job_id, None)
+        self._previews.pop(job_id, None)
+        self._workers.pop(job_id, None)
+        self._cancelled.discard(job_id)
+        if kind == 'done':
+            loop.call_soon_threadsafe(_set_result, future, payload)
+        elif kind == 'cancelled':
+            loop.call_soon_threadsafe(_set_exception, future, JobCancelled(f"Job {job_id} was cancelled"))
+        else:
+            loop.call_soon_threadsafe(_set_exception, future, RuntimeError(payload))
+
+    def busy(self):
+        """
+        Number of workers executing a job right now
+        """
+        return len(self._workers)
+
+    def alive(self):
+        return sum(process.is_alive() for process in self._processes)
+
+    def shutdown(self, timeout: float = 5):
+        # Workers stopped from here on must not be started again
+        self._closing = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+        if self._collector is not None:
+            self._collector.join(timeout)
+        self._processes = []
+
+
+def _set_result(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exception: Exception):
+    if not future.done():
+        future.set_exception(exception)
@@ -11,14 +11,20 @@ from scipy.spatial import ConvexHull
 import numpy as np
 
 from sync_batchnorm import DataParallelWithCallback
+from modules.util import inverse_2x2
 
 
 def normalize_kp(kp_source, kp_driving, kp_driving_initial, adapt_movement_scale=False,
                  use_relative_movement=False, use_relative_jacobian=False):
     if adapt_movement_scale:
-        source_area = ConvexHull(kp_source['value'][0].data.cpu().numpy()).volume
-        driving_area = ConvexHull(kp_driving_initial['value'][0].data.cpu().numpy()).volume
+        # Every keypoints argument may hold a batch, scale is computed for every item
+        source_area = np.array([ConvexHull(kp).volume for kp in kp_source['value'].data.cpu().numpy()])
+        driving_area = np.array([ConvexHull(kp).volume for kp in kp_driving_initial['value'].data.cpu().numpy()])
         adapt_movement_scale = np.sqrt(source_area) / np.sqrt(driving_area)
+        if len(adapt_movement_scale) == 1:
+            adapt_movement_scale = adapt_movement_scale[0]
+        else:
+            adapt_movement_scale = torch.tensor(adapt_movement_scale).type(kp_driving['value'].type()).view(-1, 1, 1)
     else:
         adapt_movement_scale = 1
 
@@ -30,7 +36,7 @@ def normalize_kp(kp_source, kp_driving, kp_driving_initial, adapt_movement_scale
         kp_new['value'] = kp_value_diff + kp_source['value']
 
         if use_relative_jacobian:
-            jacobian_diff = torch.matmul(kp_driving['jacobian'], torch.inverse(kp_driving_initial['jacobian']))
+            jacobian_diff = torch.matmul(kp_driving['jacobian'], inverse_2x2(kp_driving_initial['jacobian']))
             kp_new['jacobian'] = torch.matmul(jacobian_diff, kp_source['jacobian'])
 
     return kp_new
@@ -61,6 +67,7 @@ def animate(config, generator, kp_detector, checkpoint, log_dir, dataset):
 
     generator.eval()
     kp_detector.eval()
+    generator_module = generator.module if isinstance(generator, DataParallelWithCallback) else generator
 
     for it, x in tqdm(enumerate(dataloader)):
         with torch.no_grad():
@@ -72,13 +79,14 @@ def animate(config, generator, kp_detector, checkpoint, log_dir, dataset):
 
             kp_source = kp_detector(source_frame)
             kp_driving_initial = kp_detector(driving_video[:, :, 0])
+            source_state = generator_module.encode_source(source_frame, kp_source)
 
             for frame_idx in range(driving_video.shape[2]):
                 driving_frame = driving_video[:, :, frame_idx]
                 kp_driving = kp_detector(driving_frame)
                 kp_norm = normalize_kp(kp_source=kp_source, kp_driving=kp_driving,
                                        kp_driving_initial=kp_driving_initial, **animate_params['normalization_params'])
-                out = generator(source_frame, kp_source=kp_source, kp_driving=kp_norm)
+                out = generator_module.decode(source_state, kp_driving=kp_norm)
 
                 out['kp_driving'] = kp_driving
                 out['kp_source'] = kp_source
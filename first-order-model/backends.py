@@ -0,0 +1,290 @@
+"""
+Inference backends of KPDetector and OcclusionAwareGenerator: eager torch or ONNX Runtime on CPU.
+Both give objects with the interface used by demo.py (kp_detector(frames), generator(...), encode_source, decode),
+so the animation code doesn't depend on the backend.
+
+Export the ONNX graphs and compare them with torch:
+
+    python backends.py --config config/vox-256.yaml --checkpoint vox-cpk.pth.tar
+"""
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from torch import nn
+
+from demo import load_checkpoints
+from modules.generator import OcclusionAwareGenerator
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+BACKENDS = ('torch', 'onnx')
+ONNX_FILES = ('kp_detector.onnx', 'generator_encode.onnx', 'generator_decode.onnx')
+
+
+def default_onnx_dir(checkpoint_path):
+    """
+    vox-cpk.pth.tar -> vox-cpk_onnx
+    """
+    path = checkpoint_path
+    for extension in ('.tar', '.pth'):
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+    return path + '_onnx'
+
+
+def flatten(tree, prefix=''):
+    """
+    Nested dict of tensors as a list of ('a.b', tensor), the order of the dicts is kept
+    """
+    items = []
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            items += flatten(value, prefix + key + '.')
+        else:
+            items.append((prefix + key, value))
+    return items
+
+
+def unflatten(items):
+    tree = dict()
+    for name, value in items:
+        *path, key = name.split('.')
+        node = tree
+        for part in path:
+            node = node.setdefault(part, dict())
+        node[key] = value
+    return tree
+
+
+class _KPDetectorGraph(nn.Module):
+    def __init__(self, kp_detector, outputs):
+        super(_KPDetectorGraph, self).__init__()
+        self.kp_detector = kp_detector
+        self.outputs = outputs
+
+    def forward(self, frames):
+        kp = self.kp_detector(frames)
+        return tuple(kp[k] for k in self.outputs)
+
+
+class _EncodeGraph(nn.Module):
+    def __init__(self, generator, kp_names, state_names):
+        super(_EncodeGraph, self).__init__()
+        self.generator = generator
+        self.kp_names = kp_names
+        self.state_names = state_names
+
+    def forward(self, source_image, *kp_source):
+        state = self.generator.encode_source(source_image, dict(zip(self.kp_names, kp_source)))
+        state = dict(flatten(state))
+        return tuple(state[name] for name in self.state_names)
+
+
+class _DecodeGraph(nn.Module):
+    def __init__(self, generator, kp_names, state_names):
+        super(_DecodeGraph, self).__init__()
+        self.generator = generator
+        self.kp_names = kp_names
+        self.state_names = state_names
+
+    def forward(self, *inputs):
+        state = unflatten(zip(self.state_names, inputs[:len(self.state_names)]))
+        kp_driving = dict(zip(self.kp_names, inputs[len(self.state_names):]))
+        return self.generator.decode(state, kp_driving, inference=True)['prediction']
+
+
+def export_onnx(generator, kp_detector, onnx_dir, frame_shape=(256, 256), opset=17):
+    """
+    Write kp_detector.onnx, generator_encode.onnx (the source part) and generator_decode.onnx (prediction
+    for driving keypoints) to onnx_dir. The batch dimension of every graph is dynamic.
+    """
+    os.makedirs(onnx_dir, exist_ok=True)
+    source = torch.rand(1, 3, *frame_shape)
+    with torch.no_grad():
+        kp = kp_detector(source)
+        state = generator.encode_source(source, kp)
+    kp_names = list(kp)
+    state_names = [name for name, _ in flatten(state)]
+    kp_source = tuple(kp[k] for k in kp_names)
+    state_values = tuple(value for _, value in flatten(state))
+
+    def batch_axes(names):
+        return {name: {0: 'batch'} for name in names}
+
+    graphs = [
+        ('kp_detector.onnx', _KPDetectorGraph(kp_detector, kp_names), (source,), ['frames'], kp_names),
+        ('generator_encode.onnx', _EncodeGraph(generator, kp_names, state_names), (source,) + kp_source,
+         ['source'] + ['kp.' + k for k in kp_names], state_names),
+        ('generator_decode.onnx', _DecodeGraph(generator, kp_names, state_names), state_values + kp_source,
+         state_names + ['kp_driving.' + k for k in kp_names], ['prediction']),
+    ]
+    for filename, graph, args, input_names, output_names in graphs:
+        torch.onnx.export(graph.eval(), args, os.path.join(onnx_dir, filename), opset_version=opset,
+                          input_names=input_names, output_names=output_names,
+                          dynamic_axes=batch_axes(input_names + output_names), dynamo=False)
+
+
+class OnnxModel:
+    """
+    ONNX Runtime session on CPU that takes and returns torch tensors by name
+    """
+
+    def __init__(self, path, threads=0):
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is required for the onnx backend")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # The thread budget of the process is set for torch (see torch.set_num_threads in the bot workers)
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        # Errors of onnxruntime (Fail, InvalidGraph, InvalidProtobuf, ...) don't share a base class in every
+        # version, they are raised as RuntimeError
+        try:
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        except Exception as e:
+            raise RuntimeError(f"onnxruntime can't load {path}: {e}") from e
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.output_names = [node.name for node in self.session.get_outputs()]
+
+    def run(self, inputs):
+        # Expanded (stride 0) tensors of a shared source state are copied here
+        feed = {name: np.ascontiguousarray(inputs[name].detach().cpu().numpy(), dtype=np.float32)
+                for name in self.input_names}
+        try:
+            outputs = self.session.run(self.output_names, feed)
+        except Exception as e:
+            raise RuntimeError(f"onnxruntime failed: {e}") from e
+        return {name: torch.from_numpy(output) for name, output in zip(self.output_names, outputs)}
+
+
+class OnnxKPDetector:
+    def __init__(self, onnx_dir, threads=0):
+        self.model = OnnxModel(os.path.join(onnx_dir, 'kp_detector.onnx'), threads=threads)
+
+    def __call__(self, frames):
+        return self.model.run({'frames': frames})
+
+
+class OnnxGenerator:
+    """
+    OcclusionAwareGenerator in inference mode: only the prediction is returned
+    """
+
+    expand_source_state = staticmethod(OcclusionAwareGenerator.expand_source_state)
+
+    def __init__(self, onnx_dir, threads=0):
+        self.encoder = OnnxModel(os.path.join(onnx_dir, 'generator_encode.onnx'), threads=threads)
+        self.decoder = OnnxModel(os.path.join(onnx_dir, 'generator_decode.onnx'), threads=threads)
+
+    def encode_source(self, source_image, kp_source):
+        # Inputs are named apart from the outputs, the state returns source_image and kp_source as they are
+        inputs = dict(flatten({'kp': kp_source}), source=source_image)
+        return unflatten(self.encoder.run(inputs).items())
+
+    def decode(self, source_state, kp_driving, inference=True):
+        inputs = dict(flatten(source_state) + flatten({'kp_driving': kp_driving}))
+        return self.decoder.run(inputs)
+
+    def __call__(self, source_image, kp_driving, kp_source, inference=True):
+        return self.decode(self.encode_source(source_image, kp_source), kp_driving)
+
+
+def load_models(config_path, checkpoint_path, cpu=False, backend='torch', onnx_dir=None, threads=0):
+    """
+    (generator, kp_detector) of the backend. The onnx backend runs on CPU, its graphs are exported
+    from the checkpoint by export_onnx (onnx_dir defaults to the checkpoint path without extension + '_onnx').
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend %s, use one of %s" % (backend, BACKENDS))
+    if backend == 'torch':
+        return load_checkpoints(config_path=config_path, checkpoint_path=checkpoint_path, cpu=cpu)
+    if not cpu:
+        raise ValueError("The onnx backend runs only on CPU")
+    onnx_dir = onnx_dir or default_onnx_dir(checkpoint_path)
+    for filename in ONNX_FILES:
+        if not os.path.exists(os.path.join(onnx_dir, filename)):
+            raise FileNotFoundError(os.path.join(onnx_dir, filename))
+    return OnnxGenerator(onnx_dir, threads=threads), OnnxKPDetector(onnx_dir, threads=threads)
+
+
+def check_parity(reference, candidate, batch_size=2, frame_shape=(256, 256), atol=1e-3, seed=0):
+    """
+    Max absolute differences of keypoints and predictions of two (generator, kp_detector) pairs on random frames,
+    ValueError if any of them is above atol. Both the forward and the encode/expand/decode paths are compared.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    source = torch.rand(1, 3, *frame_shape, generator=generator)
+    driving = torch.rand(batch_size, 3, *frame_shape, generator=generator)
+
+    def run(models):
+        models_generator, kp_detector = models
+        with torch.no_grad():
+            kp_source, kp_driving = kp_detector(source), kp_detector(driving)
+            forward = models_generator(source.expand(batch_size, -1, -1, -1), kp_driving=kp_driving,
+                                       kp_source={k: v.expand(batch_size, *v.shape[1:]) for k, v in kp_source.items()},
+                                       inference=True)
+            state = models_generator.expand_source_state(models_generator.encode_source(source, kp_source),
+                                                         batch_size)
+            decode = models_generator.decode(state, kp_driving=kp_driving, inference=True)
+        outputs = dict(flatten({'kp': kp_driving}))
+        outputs.update(forward=forward['prediction'], decode=decode['prediction'])
+        return outputs
+
+    expected, actual = run(reference), run(candidate)
+    differences = {name: (expected[name] - actual[name]).abs().max().item() for name in expected}
+    failed = {name: difference for name, difference in differences.items() if not difference <= atol}
+    if failed:
+        raise ValueError("Backends differ by more than %g: %s" % (atol, failed))
+    return differences
+
+
+def benchmark(models, batch_size=1, frame_shape=(256, 256), repeats=5):
+    """
+    Milliseconds per batch of kp_detector and of the generator
+    """
+    generator, kp_detector = models
+    frames = torch.rand(batch_size, 3, *frame_shape)
+    timings = dict()
+    with torch.no_grad():
+        kp = kp_detector(frames)
+        calls = {'kp_detector': lambda: kp_detector(frames),
+                 'generator': lambda: generator(frames, kp_driving=kp, kp_source=kp, inference=True)}
+        for name, call in calls.items():
+            call()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                call()
+            timings[name] = (time.perf_counter() - start) / repeats * 1000
+    return timings
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--config", required=True, help="path to config")
+    parser.add_argument("--checkpoint", default='vox-cpk.pth.tar', help="path to checkpoint to restore")
+    parser.add_argument("--onnx_dir", default=None, help="output directory, by default next to the checkpoint")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--atol", type=float, default=1e-3, help="allowed difference from torch")
+    parser.add_argument("--batch_size", type=int, default=1, help="frames in every call of the benchmark")
+    parser.add_argument("--repeats", type=int, default=0, help="calls to average in the benchmark (0 - no benchmark)")
+    opt = parser.parse_args()
+
+    onnx_dir = opt.onnx_dir or default_onnx_dir(opt.checkpoint)
+    torch_models = load_models(opt.config, opt.checkpoint, cpu=True, backend='torch')
+    export_onnx(*torch_models, onnx_dir, opset=opt.opset)
+    print(f"Exported {', '.join(ONNX_FILES)} to {onnx_dir}")
+
+    onnx_models = load_models(opt.config, opt.checkpoint, cpu=True, backend='onnx', onnx_dir=onnx_dir)
+    for name, difference in check_parity(torch_models, onnx_models, atol=opt.atol).items():
+        print(f"max |torch - onnx| of {name}: {difference:.2e}")
+
+    if opt.repeats:
+        for backend, models in (('torch', torch_models), ('onnx', onnx_models)):
+            timings = benchmark(models, batch_size=opt.batch_size, repeats=opt.repeats)
+            print(f"{backend:<6}" + ''.join(f"{name} {ms:.1f} ms  " for name, ms in timings.items()))
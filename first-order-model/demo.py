@@ -9,23 +9,26 @@ from tqdm import tqdm
 import imageio
 import numpy as np
 import crop
-from skimage.transform import resize
 from skimage import img_as_ubyte
 import torch
-from sync_batchnorm import DataParallelWithCallback
 
 from modules.generator import OcclusionAwareGenerator
 from modules.keypoint_detector import KPDetector
 from animate import normalize_kp
 from scipy.spatial import ConvexHull
 import cv2
+from upscale import TIERS, get_upscaler
+from optimize import fold_batch_norm
 
 
 if sys.version_info[0] < 3:
     raise Exception("You must use Python 3 or higher. Recommended version is Python 3.7")
 
 
-def load_checkpoints(config_path, checkpoint_path, cpu=False):
+def load_checkpoints(config_path, checkpoint_path, cpu=False, fold_bn=True):
+    """
+    Generator and keypoint detector in eval mode, fold_bn merges their batch norms into convolutions (inference only)
+    """
     with open(config_path) as f:
         config = yaml.load(f)
 
@@ -47,89 +50,402 @@ def load_checkpoints(config_path, checkpoint_path, cpu=False):
     generator.load_state_dict(checkpoint['generator'])
     kp_detector.load_state_dict(checkpoint['kp_detector'])
 
-    if not cpu:
-        generator = DataParallelWithCallback(generator)
-        kp_detector = DataParallelWithCallback(kp_detector)
-
+    # Models are used on a single device, DataParallel would only add a scatter and a gather to every call
     generator.eval()
     kp_detector.eval()
+    if fold_bn:
+        fold_batch_norm(generator)
+        fold_batch_norm(kp_detector)
 
     return generator, kp_detector
 
 
-def make_animation(source_images, driving_video, generator, kp_detector, relative=True, adapt_movement_scale=True,
-                   cpu=False):
-    with torch.no_grad():
-        predictions = []
-        source = [torch.tensor(s[np.newaxis].astype(np.float32)).permute(0, 3, 1, 2) for s in source_images]
-        driving = torch.tensor(np.array(driving_video)[np.newaxis].astype(np.float32)).permute(0, 4, 1, 2, 3)
-        if not cpu:
-            source = [s.cuda() for s in source]
-        kp_source = [kp_detector(s) for s in source]
-        kp_source_value = [kp_s['value'][0].detach().cpu().numpy() for kp_s in kp_source]
-        kp_driving_initial = kp_detector(driving[:, :, 0])
+def frame_to_tensor(frame, cpu=False):
+    return frames_to_tensor([frame], cpu=cpu)
+
+
+def frames_to_tensor(frames, cpu=False):
+    """
+    Float tensor of a batch of HxWx3 frames in [0, 1], uint8 frames are converted after the copy to the device
+    """
+    frames = torch.from_numpy(np.stack(frames)).permute(0, 3, 1, 2)
+    if not cpu:
+        frames = frames.cuda()
+    if frames.dtype == torch.uint8:
+        return frames.float().div_(255)
+    return frames.float()
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def auto_batch_size(cpu=False, limit=16, frame_memory=128 * 1024 ** 2):
+    """
+    Largest batch of 256x256 frames that needs no more than half of the free memory.
+    frame_memory is the measured peak of kp_detector + generator per frame.
+    """
+    if cpu:
+        try:
+            free = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            return 1
+    else:
+        free = torch.cuda.get_device_properties(0).total_memory - torch.cuda.memory_allocated()
+    return int(max(1, min(limit, free // 2 // frame_memory)))
+
+
+def detect_keypoints(driving_frames, kp_detector, cpu=False, batch_size=1):
+    """
+    Lazily run kp_detector over the driving frames, yields keypoints of batches of up to batch_size frames
+    """
+    for batch in iter_batches(driving_frames, batch_size):
+        with torch.no_grad():
+            yield kp_detector(frames_to_tensor(batch, cpu=cpu))
+
+
+def kp_to_numpy(kp):
+    return {k: v.data.cpu().numpy() for k, v in kp.items()}
+
+
+def stack_trajectory(kps):
+    """
+    Join keypoints of batches (as returned by kp_to_numpy) into a trajectory: dict of (num_frames, ...) arrays
+    """
+    return {k: np.concatenate([kp[k] for kp in kps]) for k in kps[0]}
+
 
-        distance = lambda y: lambda x: np.sum(np.sum((x - y) ** 2, axis=1) ** 0.5)
+def compute_trajectory(driving_video, kp_detector, cpu=False, batch_size=1):
+    """
+    Keypoints of every driving frame. They depend only on the driving video and can be reused with any source
+    """
+    return stack_trajectory([kp_to_numpy(kp) for kp in detect_keypoints(driving_video, kp_detector, cpu=cpu,
+                                                                        batch_size=batch_size)])
 
-        kp_frame_value = kp_driving_initial['value'][0].detach().cpu().numpy()
-        i_prev = np.argmin(list(map(distance(kp_frame_value), kp_source_value)))
-        kp_source_prev, source_prev = kp_source[i_prev], source[i_prev]
 
-        diff = 20
+def iter_trajectory(trajectory, cpu=False, batch_size=1):
+    """
+    Keypoints of a precomputed trajectory in the format of kp_detector output, in batches of up to batch_size frames
+    """
+    for start in range(0, len(trajectory['value']), batch_size):
+        kp = {k: torch.tensor(trajectory[k][start:start + batch_size])
+              for k in ('value', 'jacobian') if k in trajectory}
+        if not cpu:
+            kp = {k: v.cuda() for k, v in kp.items()}
+        yield kp
+
+
+def split_kp(kp, index):
+    return {k: v[index:index + 1] for k, v in kp.items()}
+
+
+def decimation_stride(fps, render_fps=None):
+    """
+    Every stride-th driving frame is rendered, so that no more than render_fps frames per second are generated
+    """
+    if not render_fps or fps <= render_fps:
+        return 1
+    return int(np.ceil(fps / render_fps))
+
+
+def decimate_kp(driving_kp, stride, batch_size=1):
+    """
+    Keypoints of every stride-th frame (starting from the first one) of a stream of keypoint batches,
+    regrouped into batches of up to batch_size frames
+    """
+    pending, offset = [], 0
+    for kp in driving_kp:
+        size = kp['value'].shape[0]
+        keep = [i for i in range(size) if (offset + i) % stride == 0]
+        offset += size
+        if keep:
+            pending.append({k: v[keep] for k, v in kp.items()})
+        while sum(p['value'].shape[0] for p in pending) >= batch_size:
+            kp = {k: torch.cat([p[k] for p in pending]) for k in pending[0]}
+            yield {k: v[:batch_size] for k, v in kp.items()}
+            rest = {k: v[batch_size:] for k, v in kp.items()}
+            pending = [rest] if rest['value'].shape[0] else []
+    if pending:
+        yield {k: torch.cat([p[k] for p in pending]) for k in pending[0]}
+
+
+def interpolate_frames(keyframes, stride, total=None):
+    """
+    Frames at the original rate from frames rendered for every stride-th driving frame:
+    frames in between are blends of the two neighbouring rendered frames, weighted by the distance to them.
+    After the last rendered frame it is repeated up to total frames. total may be a function,
+    if the number of driving frames is known only by the end of the stream.
+    """
+    previous, emitted = None, 0
+    for frame in keyframes:
+        if previous is not None:
+            for j in range(1, stride):
+                t = j / stride
+                yield cv2.addWeighted(previous, 1 - t, frame, t, 0)
+            emitted += stride - 1
+        yield frame
+        emitted += 1
+        previous = frame
+    if previous is None:
+        return
+    total = total() if callable(total) else total
+    for _ in range(max(0, (total or 0) - emitted)):
+        yield previous
+
+
+class SourceIndex:
+    """
+    Keypoints of every frame of a source video, detected in batches and stacked for vectorized
+    nearest-frame queries. The distance between two frames is the sum of the distances between their keypoints.
+    Frames are converted to tensors only when they are chosen.
+    """
+
+    def __init__(self, source_images, kp_detector, cpu=False, batch_size=1):
+        self.frames = source_images
+        self.cpu = cpu
+        kps = list(detect_keypoints(source_images, kp_detector, cpu=cpu, batch_size=batch_size))
+        self.kp_source = {k: torch.cat([kp[k] for kp in kps]) for k in kps[0]}
+        self.values = self.kp_source['value'].cpu().numpy()
+        self._last = (None, None)
+
+    def __len__(self):
+        return len(self.values)
+
+    def distances(self, kp_values):
+        """
+        (frames, source frames) distances from keypoint values of a batch of driving frames
+        """
+        return np.sqrt(((kp_values[:, np.newaxis] - self.values[np.newaxis]) ** 2).sum(-1)).sum(-1)
+
+    def nearest(self, distances, around=None, window=None):
+        """
+        The nearest source frame by a row of distances, among frames [around - window, around + window)
+        or all of them if window is None
+        """
+        if window is None or around is None:
+            return int(np.argmin(distances))
+        start = max(0, around - window)
+        return start + int(np.argmin(distances[start:min(len(self), around + window)]))
+
+    def kp(self, i):
+        return split_kp(self.kp_source, i)
+
+    def frame(self, i):
+        # The same frame is usually chosen for many driving frames in a row
+        if self._last[0] != i:
+            self._last = (i, frame_to_tensor(self.frames[i], cpu=self.cpu))
+        return self._last[1]
+
+
+def iter_animation(source_images, driving_frames, generator, kp_detector, relative=True, adapt_movement_scale=True,
+                   cpu=False, progress_callback=None, num_frames=None, driving_kp=None, batch_size=1, window=20):
+    """
+    Lazy version of make_animation: driving frames are consumed and predictions are yielded one by one.
+    Precomputed keypoints of the driving frames can be given as driving_kp (batches of kp_detector outputs)
+    instead of the frames. Up to batch_size frames go through kp_detector and generator at once,
+    None chooses the batch size by free memory.
+    Every driving frame is animated from the source frame with the nearest keypoints within window frames
+    of the previously chosen one, window=None searches the whole source video.
+    """
+    if batch_size is None:
+        batch_size = auto_batch_size(cpu=cpu)
+    if driving_kp is None:
+        driving_kp = detect_keypoints(driving_frames, kp_detector, cpu=cpu, batch_size=batch_size)
+    with torch.no_grad():
+        index = SourceIndex(source_images, kp_detector, cpu=cpu, batch_size=batch_size)
+        kp_driving_initial = None
         alpha = 0
-        n = len(source_images)
-
-        for frame_idx in tqdm(range(driving.shape[2])):
-            driving_frame = driving[:, :, frame_idx]
-            if not cpu:
-                driving_frame = driving_frame.cuda()
-            kp_driving = kp_detector(driving_frame)
-            kp_frame_value = kp_driving['value'][0].detach().cpu().numpy()
-
-            i = np.argmin(list(map(distance(kp_frame_value), kp_source_value[max(0, i_prev - diff):min(n, i_prev + diff)])))
-            i += max(0, i_prev - diff)
-
-            if i != i_prev:
-                kp_source_prev['value'] = (kp_source_prev['value'] + kp_source[i]['value']) / 2
-                kp_source_prev['jacobian'] = (kp_source_prev['jacobian'] + kp_source[i]['jacobian']) / 2
-                source_prev = (source_prev + source[i]) / 2
-                i_prev = i
-            else:
-                kp_source_prev['value'] = alpha * kp_source_prev['value'] + (1 - alpha) * kp_source[i]['value']
-                kp_source_prev['jacobian'] = alpha * kp_source_prev['jacobian'] + (1 - alpha) * kp_source[i]['jacobian']
-                source_prev = alpha * source_prev + (1 - alpha) * source[i]
 
-            kp_norm = normalize_kp(kp_source=kp_source_prev, kp_driving=kp_driving,
+        frame_idx = 0
+        progress = tqdm(total=num_frames)
+        for kp_driving in driving_kp:
+            distances = index.distances(kp_driving['value'].detach().cpu().numpy())
+            batch_source, batch_kp_value, batch_kp_jacobian = [], [], []
+
+            # Choice of the source frame is sequential, but it needs only the distances
+            for row in distances:
+                if kp_driving_initial is None:
+                    kp_driving_initial = split_kp(kp_driving, 0)
+                    i_prev = index.nearest(row)
+                    kp_source_prev, source_prev = index.kp(i_prev), index.frame(i_prev)
+
+                i = index.nearest(row, i_prev, window)
+                kp_source_i = index.kp(i)
+                if i != i_prev:
+                    kp_source_prev = {k: (kp_source_prev[k] + kp_source_i[k]) / 2 for k in kp_source_prev}
+                    source_prev = (source_prev + index.frame(i)) / 2
+                    i_prev = i
+                else:
+                    kp_source_prev = {k: alpha * kp_source_prev[k] + (1 - alpha) * kp_source_i[k]
+                                      for k in kp_source_prev}
+                    source_prev = alpha * source_prev + (1 - alpha) * index.frame(i)
+
+                batch_source.append(source_prev)
+                batch_kp_value.append(kp_source_prev['value'])
+                batch_kp_jacobian.append(kp_source_prev['jacobian'])
+
+            batch_kp_source = {'value': torch.cat(batch_kp_value), 'jacobian': torch.cat(batch_kp_jacobian)}
+            kp_norm = normalize_kp(kp_source=batch_kp_source, kp_driving=kp_driving,
                                    kp_driving_initial=kp_driving_initial, use_relative_movement=relative,
                                    use_relative_jacobian=relative, adapt_movement_scale=adapt_movement_scale)
-            out = generator(source_prev, kp_source=kp_source_prev, kp_driving=kp_norm)
-
-            predictions.append(np.transpose(out['prediction'].data.cpu().numpy(), [0, 2, 3, 1])[0])
-    return predictions
+            out = generator(torch.cat(batch_source), kp_source=batch_kp_source, kp_driving=kp_norm, inference=True)
+
+            for prediction in np.transpose(out['prediction'].data.cpu().numpy(), [0, 2, 3, 1]):
+                yield prediction
+                frame_idx += 1
+                progress.update(1)
+                # Called after every frame, may raise to stop the animation early
+                if progress_callback is not None:
+                    progress_callback(frame_idx, num_frames or frame_idx)
+        progress.close()
+
+
+def driving_input(driving_video, trajectory, cpu=False, batch_size=1):
+    """
+    Keypoints of the trajectory or the driving frames (a list or a lazy stream, e.g. iter_frames),
+    number of driving frames - an int or a function for a stream of unknown length
+    """
+    if trajectory is not None:
+        return driving_video, iter_trajectory(trajectory, cpu=cpu, batch_size=batch_size), len(trajectory['value'])
+    if hasattr(driving_video, '__len__'):
+        return driving_video, None, len(driving_video)
+    driving_video, num_frames = counted(driving_video)
+    return driving_video, None, num_frames
 
 
-def make_photo_animation(source_image, driving_video, generator, kp_detector, relative=True, adapt_movement_scale=True, cpu=False):
+def make_animation(source_images, driving_video, generator, kp_detector, relative=True, adapt_movement_scale=True,
+                   cpu=False, progress_callback=None, trajectory=None, batch_size=1, stride=1, stream=False,
+                   window=20):
+    """
+    stream=True returns a lazy iterator of the frames instead of a list,
+    window - how far from the previous source frame the next one is searched (None - the whole source video)
+    """
+    if batch_size is None:
+        batch_size = auto_batch_size(cpu=cpu)
+    driving_video, driving_kp, num_frames = driving_input(driving_video, trajectory, cpu=cpu, batch_size=batch_size)
+    if stride > 1:
+        # Only every stride-th frame is generated, the rest are interpolated
+        if driving_kp is None:
+            driving_kp = detect_keypoints(driving_video, kp_detector, cpu=cpu, batch_size=batch_size)
+        driving_kp = decimate_kp(driving_kp, stride, batch_size)
+    rendered_frames = None if callable(num_frames) else (num_frames + stride - 1) // stride
+    predictions = iter_animation(source_images, driving_video, generator, kp_detector, relative=relative,
+                                 adapt_movement_scale=adapt_movement_scale, cpu=cpu,
+                                 progress_callback=progress_callback,
+                                 num_frames=rendered_frames,
+                                 driving_kp=driving_kp, batch_size=batch_size, window=window)
+    frames = interpolate_frames(predictions, stride, num_frames)
+    return frames if stream else list(frames)
+
+
+def select_moving_frames(kp_norm, last_kp, threshold):
+    """
+    Indices of the frames of a batch that moved by at least threshold (max difference of keypoint values and
+    jacobians) relative to the last frame chosen for generation, and the keypoints of the last chosen frame.
+    The first frame ever (last_kp is None) is always chosen.
+    """
+    render = []
+    for i in range(kp_norm['value'].shape[0]):
+        kp = {k: v[i] for k, v in kp_norm.items()}
+        if last_kp is not None:
+            moved = max(float((kp[k] - last_kp[k]).abs().max()) for k in kp)
+            if moved < threshold:
+                continue
+        render.append(i)
+        last_kp = kp
+    return render, last_kp
+
+
+def iter_photo_animation(source_image, driving_frames, generator, kp_detector, relative=True,
+                         adapt_movement_scale=True, cpu=False, progress_callback=None, num_frames=None,
+                         driving_kp=None, batch_size=1, reuse_threshold=None, stats=None, kp_driving_initial=None):
+    """
+    Lazy version of make_photo_animation: driving frames are consumed and predictions are yielded one by one.
+    Precomputed keypoints of the driving frames can be given as driving_kp (batches of kp_detector outputs)
+    instead of the frames. Up to batch_size frames go through kp_detector and generator at once,
+    None chooses the batch size by free memory.
+    With reuse_threshold, a frame whose keypoints and jacobians differ from the last generated frame
+    by less than the threshold repeats that prediction instead of running the generator.
+    The number of such frames is counted in stats['skipped_frames'].
+    kp_driving_initial - keypoints of the first frame of the whole driving video, if driving_kp is a part of it
+    (relative motion is measured from that frame, so the parts can be rendered independently).
+    """
+    if batch_size is None:
+        batch_size = auto_batch_size(cpu=cpu)
+    if driving_kp is None:
+        driving_kp = detect_keypoints(driving_frames, kp_detector, cpu=cpu, batch_size=batch_size)
     with torch.no_grad():
-        predictions = []
-        source = torch.tensor(source_image[np.newaxis].astype(np.float32)).permute(0, 3, 1, 2)
-        if not cpu:
-            source = source.cuda()
-        driving = torch.tensor(np.array(driving_video)[np.newaxis].astype(np.float32)).permute(0, 4, 1, 2, 3)
+        source = frame_to_tensor(source_image, cpu=cpu)
         kp_source = kp_detector(source)
-        kp_driving_initial = kp_detector(driving[:, :, 0])
+        source_state = generator.encode_source(source, kp_source)
 
-        for frame_idx in tqdm(range(driving.shape[2])):
-            driving_frame = driving[:, :, frame_idx]
-            if not cpu:
-                driving_frame = driving_frame.cuda()
-            kp_driving = kp_detector(driving_frame)
+        stats = stats if stats is not None else dict()
+        stats.setdefault('skipped_frames', 0)
+        last_kp, last_prediction = None, None
+
+        frame_idx = 0
+        progress = tqdm(total=num_frames)
+        for kp_driving in driving_kp:
+            if kp_driving_initial is None:
+                kp_driving_initial = split_kp(kp_driving, 0)
             kp_norm = normalize_kp(kp_source=kp_source, kp_driving=kp_driving,
                                    kp_driving_initial=kp_driving_initial, use_relative_movement=relative,
                                    use_relative_jacobian=relative, adapt_movement_scale=adapt_movement_scale)
-            out = generator(source, kp_source=kp_source, kp_driving=kp_norm)
-
-            predictions.append(np.transpose(out['prediction'].data.cpu().numpy(), [0, 2, 3, 1])[0])
-    return predictions
+            size = kp_driving['value'].shape[0]
+            if reuse_threshold is None:
+                render = list(range(size))
+            else:
+                render, last_kp = select_moving_frames(kp_norm, last_kp, reuse_threshold)
+                stats['skipped_frames'] += size - len(render)
+
+            predictions = dict()
+            if render:
+                batch_kp = kp_norm if len(render) == size else {k: v[render] for k, v in kp_norm.items()}
+                batch_state = generator.expand_source_state(source_state, len(render))
+                out = generator.decode(batch_state, kp_driving=batch_kp, inference=True)
+                predictions = dict(zip(render, np.transpose(out['prediction'].data.cpu().numpy(), [0, 2, 3, 1])))
+
+            for i in range(size):
+                prediction = last_prediction = predictions.get(i, last_prediction)
+                yield prediction
+                frame_idx += 1
+                progress.update(1)
+                # Called after every frame, may raise to stop the animation early
+                if progress_callback is not None:
+                    progress_callback(frame_idx, num_frames or frame_idx)
+        progress.close()
+
+
+def make_photo_animation(source_image, driving_video, generator, kp_detector, relative=True, adapt_movement_scale=True,
+                         cpu=False, progress_callback=None, trajectory=None, batch_size=1, stride=1,
+                         reuse_threshold=None, stats=None, stream=False):
+    """
+    stream=True returns a lazy iterator of the frames instead of a list
+    """
+    if batch_size is None:
+        batch_size = auto_batch_size(cpu=cpu)
+    driving_video, driving_kp, num_frames = driving_input(driving_video, trajectory, cpu=cpu, batch_size=batch_size)
+    if stride > 1:
+        # Only every stride-th frame is generated, the rest are interpolated
+        if driving_kp is None:
+            driving_kp = detect_keypoints(driving_video, kp_detector, cpu=cpu, batch_size=batch_size)
+        driving_kp = decimate_kp(driving_kp, stride, batch_size)
+    rendered_frames = None if callable(num_frames) else (num_frames + stride - 1) // stride
+    predictions = iter_photo_animation(source_image, driving_video, generator, kp_detector, relative=relative,
+                                       adapt_movement_scale=adapt_movement_scale, cpu=cpu,
+                                       progress_callback=progress_callback,
+                                       num_frames=rendered_frames,
+                                       driving_kp=driving_kp, batch_size=batch_size,
+                                       reuse_threshold=reuse_threshold, stats=stats)
+    frames = interpolate_frames(predictions, stride, num_frames)
+    return frames if stream else list(frames)
 
 
 def find_best_frame(source, driving, cpu=False):
@@ -144,12 +460,12 @@ def find_best_frame(source, driving, cpu=False):
 
     fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=True,
                                       device='cpu' if cpu else 'cuda')
-    kp_source = fa.get_landmarks(255 * source)[0]
+    kp_source = fa.get_landmarks(img_as_ubyte(source))[0]
     kp_source = normalize_kp(kp_source)
     norm = float('inf')
     frame_num = 0
     for i, image in tqdm(enumerate(driving)):
-        kp_driving = fa.get_landmarks(255 * image)[0]
+        kp_driving = fa.get_landmarks(img_as_ubyte(image))[0]
         kp_driving = normalize_kp(kp_driving)
         new_norm = (np.abs(kp_source - kp_driving) ** 2).sum()
         if new_norm < norm:
@@ -158,29 +474,56 @@ def find_best_frame(source, driving, cpu=False):
     return frame_num
 
 def super_resolution(source_image, modelScale):
-    sr = cv2.dnn_superres.DnnSuperResImpl_create()
-    sr.readModel('../first-order-model/pretrained_models/ESPCN_x4.pb')
-    sr.setModel('espcn', modelScale)
-    upscaled = sr.upsample(source_image)
-    return upscaled
-
-def read_video(reader):
-    video = []
+    return get_upscaler('espcn', modelScale)(source_image)
+
+def resize_frame(frame, size=(256, 256)):
+    """
+    RGB uint8 frame of the model size. Area interpolation on uint8 is what skimage resize approximates
+    with anti-aliasing, without converting the full-size frame to float64
+    """
+    frame = img_as_ubyte(frame[..., :3])
+    if frame.shape[:2] == tuple(size):
+        return frame
+    return cv2.resize(frame, (size[1], size[0]), interpolation=cv2.INTER_AREA)
+
+
+def iter_video(reader):
+    """
+    Yield raw frames of the reader and close it, a broken tail of the video is skipped
+    """
     try:
         for im in reader:
-            video.append(im)
+            yield im
     except RuntimeError:
         pass
-    reader.close()
+    finally:
+        reader.close()
+
+
+def iter_frames(reader, size=(256, 256)):
+    """
+    Lazily decoded and resized frames of the reader, only one full-size frame is in memory at a time
+    """
+    return map(lambda frame: resize_frame(frame, size), iter_video(reader))
+
 
-    from multiprocessing.pool import ThreadPool
-    pool = ThreadPool(12)
+def read_video(reader, size=(256, 256)):
+    return list(iter_frames(reader, size))
 
-    def mapping_resize(frame):
-        return resize(frame, (256, 256))[..., :3]
 
-    video = list(pool.map(mapping_resize, video))
-    return video
+def counted(frames):
+    """
+    The frames and a function returning how many of them have been consumed so far,
+    for a stream whose length is known only at its end
+    """
+    count = [0]
+
+    def iterate():
+        for frame in frames:
+            count[0] += 1
+            yield frame
+
+    return iterate(), lambda: count[0]
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -203,7 +546,20 @@ if __name__ == "__main__":
                         help="Set frame to start from.")
 
     parser.add_argument("--cpu", dest="cpu", action="store_true", help="cpu mode.")
+    parser.add_argument("--backend", default='torch', choices=('torch', 'onnx'),
+                        help="inference backend, onnx runs on cpu from graphs exported by backends.py")
+    parser.add_argument("--onnx_dir", default=None, help="exported onnx graphs, by default next to the checkpoint")
+    parser.add_argument("--batch_size", dest="batch_size", type=int, default=None,
+                        help="Frames processed at once, by default chosen by free memory.")
     parser.add_argument("--from_image", dest="from_image", action="store_true")
+    parser.add_argument("--sr", default='espcn', choices=TIERS, help="super resolution of the result")
+    parser.add_argument("--render_fps", type=float, default=None,
+                        help="generate at most this many frames per second, the rest are interpolated")
+    parser.add_argument("--reuse_threshold", type=float, default=None,
+                        help="repeat the previous frame if keypoints moved less than this (photo source only)")
+    parser.add_argument("--sr_scale", type=int, default=4, help="upscaling factor of the super resolution")
+    parser.add_argument("--source_window", type=int, default=20,
+                        help="search the next source frame this far from the previous one (0 - whole source video)")
 
     parser.set_defaults(relative=False)
     parser.set_defaults(adapt_scale=False)
@@ -226,10 +582,12 @@ if __name__ == "__main__":
         print(e)
         source_reader = imageio.get_reader(opt.source_image)
 
-    if opt.from_image:
-        source_photo = resize(next(iter(source_reader)), (256, 256))[..., :3]
-    else:
-        source_video = read_video(source_reader)
+    # Only the first frame of a photo is read, the reader is closed here and not when the generator is collected
+    with source_reader:
+        if opt.from_image:
+            source_photo = next(iter_frames(source_reader))
+        else:
+            source_video = read_video(source_reader)
 
     try:
         target_reader = imageio.get_reader('crop_' + opt.driving_video)
@@ -238,22 +596,32 @@ if __name__ == "__main__":
         target_reader = imageio.get_reader(opt.driving_video)
 
     fps = target_reader.get_meta_data()['fps']
-    driving_video = read_video(target_reader)
+    driving_video = iter_frames(target_reader)
 
-    generator, kp_detector = load_checkpoints(config_path=opt.config, checkpoint_path=opt.checkpoint, cpu=opt.cpu)
+    # backends imports this module, so it can't be imported at the top
+    from backends import load_models
+    generator, kp_detector = load_models(config_path=opt.config, checkpoint_path=opt.checkpoint, cpu=opt.cpu,
+                                         backend=opt.backend, onnx_dir=opt.onnx_dir)
     if opt.from_image:
         predictions = make_photo_animation(source_photo, driving_video, generator, kp_detector,
                                            relative=opt.relative,
                                            adapt_movement_scale=opt.adapt_scale,
-                                           cpu=opt.cpu)
+                                           cpu=opt.cpu, batch_size=opt.batch_size,
+                                           stride=decimation_stride(fps, opt.render_fps),
+                                           reuse_threshold=opt.reuse_threshold, stream=True)
     else:
         predictions = make_animation(source_video, driving_video, generator, kp_detector,
                                      relative=opt.relative,
                                      adapt_movement_scale=opt.adapt_scale,
-                                     cpu=opt.cpu)
+                                     cpu=opt.cpu, batch_size=opt.batch_size,
+                                     stride=decimation_stride(fps, opt.render_fps), stream=True,
+                                     window=opt.source_window or None)
 
     #1024x1024
-    imageio.mimsave(opt.result_video, [super_resolution(img_as_ubyte(frame), 4) for frame in predictions], fps=fps)
+    upscaler = get_upscaler(opt.sr, opt.sr_scale)
+    with imageio.get_writer(opt.result_video, fps=fps) as writer:
+        for frame in upscaler.iter_upscale(map(img_as_ubyte, predictions)):
+            writer.append_data(frame)
     
     #256x256
     # imageio.mimsave(opt.result_video, [img_as_ubyte(frame) for frame in predictions], fps=fps)
@@ -1,7 +1,7 @@
 from torch import nn
 import torch.nn.functional as F
 import torch
-from modules.util import Hourglass, AntiAliasInterpolation2d, make_coordinate_grid, kp2gaussian
+from modules.util import Hourglass, AntiAliasInterpolation2d, make_coordinate_grid, kp2gaussian, inverse_2x2
 
 
 class DenseMotionNetwork(nn.Module):
@@ -29,13 +29,14 @@ class DenseMotionNetwork(nn.Module):
         if self.scale_factor != 1:
             self.down = AntiAliasInterpolation2d(num_channels, self.scale_factor)
 
-    def create_heatmap_representations(self, source_image, kp_driving, kp_source):
+    def create_heatmap_representations(self, source_image, kp_driving, kp_source, gaussian_source=None):
         """
         Eq 6. in the paper H_k(z)
         """
         spatial_size = source_image.shape[2:]
         gaussian_driving = kp2gaussian(kp_driving, spatial_size=spatial_size, kp_variance=self.kp_variance)
-        gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=self.kp_variance)
+        if gaussian_source is None:
+            gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=self.kp_variance)
         heatmap = gaussian_driving - gaussian_source
 
         #adding background feature
@@ -53,16 +54,14 @@ class DenseMotionNetwork(nn.Module):
         identity_grid = identity_grid.view(1, 1, h, w, 2)
         coordinate_grid = identity_grid - kp_driving['value'].view(bs, self.num_kp, 1, 1, 2)
         if 'jacobian' in kp_driving:
-            jacobian = torch.matmul(kp_source['jacobian'], torch.inverse(kp_driving['jacobian']))
-            jacobian = jacobian.unsqueeze(-3).unsqueeze(-3)
-            jacobian = jacobian.repeat(1, 1, h, w, 1, 1)
-            coordinate_grid = torch.matmul(jacobian, coordinate_grid.unsqueeze(-1))
-            coordinate_grid = coordinate_grid.squeeze(-1)
+            jacobian = torch.matmul(kp_source['jacobian'], inverse_2x2(kp_driving['jacobian']))
+            # One 2x2 jacobian per keypoint applied to all of its h x w points, never repeated over the grid
+            coordinate_grid = torch.einsum('bkij,bkhwj->bkhwi', jacobian, coordinate_grid)
 
         driving_to_source = coordinate_grid + kp_source['value'].view(bs, self.num_kp, 1, 1, 2)
 
         #adding background feature
-        identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1)
+        identity_grid = identity_grid.expand(bs, 1, h, w, 2)
         sparse_motions = torch.cat([identity_grid, driving_to_source], dim=1)
         return sparse_motions
 
@@ -70,25 +69,43 @@ class DenseMotionNetwork(nn.Module):
         """
         Eq 7. in the paper \hat{T}_{s<-d}(z)
         """
-        bs, _, h, w = source_image.shape
-        source_repeat = source_image.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp + 1, 1, 1, 1, 1)
-        source_repeat = source_repeat.view(bs * (self.num_kp + 1), -1, h, w)
-        sparse_motions = sparse_motions.view((bs * (self.num_kp + 1), h, w, -1))
-        sparse_deformed = F.grid_sample(source_repeat, sparse_motions)
-        sparse_deformed = sparse_deformed.view((bs, self.num_kp + 1, -1, h, w))
+        bs, c, h, w = source_image.shape
+        # The num_kp + 1 grids are stacked along the height, so the source is sampled once per image
+        # instead of being repeated for every keypoint
+        sparse_motions = sparse_motions.view(bs, (self.num_kp + 1) * h, w, 2)
+        sparse_deformed = F.grid_sample(source_image, sparse_motions)
+        sparse_deformed = sparse_deformed.view(bs, c, self.num_kp + 1, h, w).transpose(1, 2)
         return sparse_deformed
 
-    def forward(self, source_image, kp_driving, kp_source):
+    def encode_source(self, source_image, kp_source):
+        """
+        Part of the computation that depends only on the source, can be reused for every driving frame
+        """
         if self.scale_factor != 1:
             source_image = self.down(source_image)
 
+        gaussian_source = kp2gaussian(kp_source, spatial_size=source_image.shape[2:], kp_variance=self.kp_variance)
+        return {'source_image': source_image, 'kp_source': kp_source, 'gaussian_source': gaussian_source}
+
+    def forward(self, source_image, kp_driving, kp_source, inference=False):
+        return self.decode(self.encode_source(source_image, kp_source), kp_driving, inference=inference)
+
+    def decode(self, source_state, kp_driving, inference=False):
+        """
+        With inference=True sparse_deformed and mask, used only for visualization, are not returned
+        """
+        source_image = source_state['source_image']
+        kp_source = source_state['kp_source']
+
         bs, _, h, w = source_image.shape
 
         out_dict = dict()
-        heatmap_representation = self.create_heatmap_representations(source_image, kp_driving, kp_source)
+        heatmap_representation = self.create_heatmap_representations(source_image, kp_driving, kp_source,
+                                                                     source_state['gaussian_source'])
         sparse_motion = self.create_sparse_motions(source_image, kp_driving, kp_source)
         deformed_source = self.create_deformed_source_image(source_image, sparse_motion)
-        out_dict['sparse_deformed'] = deformed_source
+        if not inference:
+            out_dict['sparse_deformed'] = deformed_source
 
         input = torch.cat([heatmap_representation, deformed_source], dim=2)
         input = input.view(bs, -1, h, w)
@@ -97,11 +114,9 @@ class DenseMotionNetwork(nn.Module):
 
         mask = self.mask(prediction)
         mask = F.softmax(mask, dim=1)
-        out_dict['mask'] = mask
-        mask = mask.unsqueeze(2)
-        sparse_motion = sparse_motion.permute(0, 1, 4, 2, 3)
-        deformation = (sparse_motion * mask).sum(dim=1)
-        deformation = deformation.permute(0, 2, 3, 1)
+        if not inference:
+            out_dict['mask'] = mask
+        deformation = torch.einsum('bkhwi,bkhw->bhwi', sparse_motion, mask)
 
         out_dict['deformation'] = deformation
 
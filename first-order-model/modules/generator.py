@@ -56,25 +56,53 @@ class OcclusionAwareGenerator(nn.Module):
             deformation = deformation.permute(0, 2, 3, 1)
         return F.grid_sample(inp, deformation)
 
-    def forward(self, source_image, kp_driving, kp_source):
+    def encode_source(self, source_image, kp_source):
+        """
+        Everything that depends only on the source: encoder features and source part of the dense motion.
+        The returned state can be passed to decode with any number of driving keypoints.
+        """
         # Encoding (downsampling) part
         out = self.first(source_image)
         for i in range(len(self.down_blocks)):
             out = self.down_blocks[i](out)
 
+        source_state = {'source_image': source_image, 'kp_source': kp_source, 'feature': out}
+        if self.dense_motion_network is not None:
+            source_state['dense_motion'] = self.dense_motion_network.encode_source(source_image, kp_source)
+        return source_state
+
+    @staticmethod
+    def expand_source_state(source_state, batch_size):
+        """
+        Source state of a single image for a batch of driving keypoints, without copying the tensors
+        """
+        if isinstance(source_state, dict):
+            return {k: OcclusionAwareGenerator.expand_source_state(v, batch_size) for k, v in source_state.items()}
+        return source_state.expand(batch_size, *source_state.shape[1:])
+
+    def forward(self, source_image, kp_driving, kp_source, inference=False):
+        return self.decode(self.encode_source(source_image, kp_source), kp_driving, inference=inference)
+
+    def decode(self, source_state, kp_driving, inference=False):
+        """
+        With inference=True only the prediction is returned, tensors for the Visualizer
+        (mask, sparse_deformed, occlusion_map and the deformed source) are neither kept nor computed
+        """
+        source_image = source_state['source_image']
+        out = source_state['feature']
+
         # Transforming feature representation according to deformation and occlusion
         output_dict = {}
         if self.dense_motion_network is not None:
-            dense_motion = self.dense_motion_network(source_image=source_image, kp_driving=kp_driving,
-                                                     kp_source=kp_source)
-            output_dict['mask'] = dense_motion['mask']
-            output_dict['sparse_deformed'] = dense_motion['sparse_deformed']
-
-            if 'occlusion_map' in dense_motion:
-                occlusion_map = dense_motion['occlusion_map']
+            dense_motion = self.dense_motion_network.decode(source_state['dense_motion'], kp_driving=kp_driving,
+                                                            inference=inference)
+            if not inference:
+                output_dict['mask'] = dense_motion['mask']
+                output_dict['sparse_deformed'] = dense_motion['sparse_deformed']
+
+            occlusion_map = dense_motion.get('occlusion_map')
+            if occlusion_map is not None and not inference:
                 output_dict['occlusion_map'] = occlusion_map
-            else:
-                occlusion_map = None
             deformation = dense_motion['deformation']
             out = self.deform_input(out, deformation)
 
@@ -83,7 +111,8 @@ class OcclusionAwareGenerator(nn.Module):
                     occlusion_map = F.interpolate(occlusion_map, size=out.shape[2:], mode='bilinear')
                 out = out * occlusion_map
 
-            output_dict["deformed"] = self.deform_input(source_image, deformation)
+            if not inference:
+                output_dict["deformed"] = self.deform_input(source_image, deformation)
 
         # Decoding part
         out = self.bottleneck(out)
@@ -40,7 +40,7 @@ class KPDetector(nn.Module):
         """
         shape = heatmap.shape
         heatmap = heatmap.unsqueeze(-1)
-        grid = make_coordinate_grid(shape[2:], heatmap.type()).unsqueeze_(0).unsqueeze_(0)
+        grid = make_coordinate_grid(shape[2:], heatmap.type()).unsqueeze(0).unsqueeze(0)
         value = (heatmap * grid).sum(dim=(2, 3))
         kp = {'value': value}
 
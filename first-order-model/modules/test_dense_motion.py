@@ -0,0 +1,101 @@
+"""
+Equivalence of the rewritten sparse motions, deformed source and deformation of DenseMotionNetwork
+with the original repeat / torch.inverse implementation on random inputs.
+
+    python -m unittest modules.test_dense_motion
+"""
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from modules.dense_motion import DenseMotionNetwork
+from modules.util import make_coordinate_grid, inverse_2x2
+
+
+def reference_sparse_motions(source_image, kp_driving, kp_source, num_kp):
+    bs, _, h, w = source_image.shape
+    identity_grid = make_coordinate_grid((h, w), type=kp_source['value'].type())
+    identity_grid = identity_grid.view(1, 1, h, w, 2)
+    coordinate_grid = identity_grid - kp_driving['value'].view(bs, num_kp, 1, 1, 2)
+    if 'jacobian' in kp_driving:
+        jacobian = torch.matmul(kp_source['jacobian'], torch.inverse(kp_driving['jacobian']))
+        jacobian = jacobian.unsqueeze(-3).unsqueeze(-3)
+        jacobian = jacobian.repeat(1, 1, h, w, 1, 1)
+        coordinate_grid = torch.matmul(jacobian, coordinate_grid.unsqueeze(-1))
+        coordinate_grid = coordinate_grid.squeeze(-1)
+
+    driving_to_source = coordinate_grid + kp_source['value'].view(bs, num_kp, 1, 1, 2)
+
+    identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1)
+    return torch.cat([identity_grid, driving_to_source], dim=1)
+
+
+def reference_deformed_source_image(source_image, sparse_motions, num_kp):
+    bs, _, h, w = source_image.shape
+    source_repeat = source_image.unsqueeze(1).unsqueeze(1).repeat(1, num_kp + 1, 1, 1, 1, 1)
+    source_repeat = source_repeat.view(bs * (num_kp + 1), -1, h, w)
+    sparse_motions = sparse_motions.view((bs * (num_kp + 1), h, w, -1))
+    sparse_deformed = F.grid_sample(source_repeat, sparse_motions)
+    return sparse_deformed.view((bs, num_kp + 1, -1, h, w))
+
+
+def reference_deformation(sparse_motion, mask):
+    mask = mask.unsqueeze(2)
+    sparse_motion = sparse_motion.permute(0, 1, 4, 2, 3)
+    deformation = (sparse_motion * mask).sum(dim=1)
+    return deformation.permute(0, 2, 3, 1)
+
+
+class DenseMotionTestCase(unittest.TestCase):
+    num_kp = 10
+    shape = (3, 3, 32, 24)
+    atol = 1e-5
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.network = DenseMotionNetwork(block_expansion=8, num_blocks=2, max_features=32, num_kp=self.num_kp,
+                                          num_channels=self.shape[1]).eval()
+        bs = self.shape[0]
+        self.source_image = torch.rand(*self.shape)
+        # Jacobians near the identity, as the keypoint detector gives them, so the inverses are well conditioned
+        self.kp_source = {'value': torch.rand(bs, self.num_kp, 2) * 2 - 1,
+                          'jacobian': torch.eye(2) + 0.3 * torch.randn(bs, self.num_kp, 2, 2)}
+        self.kp_driving = {'value': torch.rand(bs, self.num_kp, 2) * 2 - 1,
+                           'jacobian': torch.eye(2) + 0.3 * torch.randn(bs, self.num_kp, 2, 2)}
+
+    def assertClose(self, actual, expected):
+        self.assertEqual(actual.shape, expected.shape)
+        difference = (actual - expected).abs().max().item()
+        self.assertLessEqual(difference, self.atol, f"max difference {difference:.2e}")
+
+    def test_inverse_2x2(self):
+        jacobian = self.kp_driving['jacobian']
+        self.assertClose(inverse_2x2(jacobian), torch.inverse(jacobian))
+
+    def test_sparse_motions(self):
+        for kp_keys in (('value', 'jacobian'), ('value',)):
+            kp_driving = {k: self.kp_driving[k] for k in kp_keys}
+            kp_source = {k: self.kp_source[k] for k in kp_keys}
+            self.assertClose(self.network.create_sparse_motions(self.source_image, kp_driving, kp_source),
+                             reference_sparse_motions(self.source_image, kp_driving, kp_source, self.num_kp))
+
+    def test_deformed_source_image(self):
+        sparse_motions = reference_sparse_motions(self.source_image, self.kp_driving, self.kp_source, self.num_kp)
+        self.assertClose(self.network.create_deformed_source_image(self.source_image, sparse_motions),
+                         reference_deformed_source_image(self.source_image, sparse_motions, self.num_kp))
+
+    def test_deformation(self):
+        with torch.no_grad():
+            out = self.network(self.source_image, self.kp_driving, self.kp_source)
+            sparse_motions = reference_sparse_motions(self.source_image, self.kp_driving, self.kp_source, self.num_kp)
+            self.assertClose(out['sparse_deformed'],
+                             reference_deformed_source_image(self.source_image, sparse_motions, self.num_kp))
+            self.assertClose(out['deformation'], reference_deformation(sparse_motions, out['mask']))
+            inference = self.network(self.source_image, self.kp_driving, self.kp_source, inference=True)
+        self.assertEqual(set(inference), {'deformation'})
+        self.assertClose(inference['deformation'], out['deformation'])
+
+
+if __name__ == '__main__':
+    unittest.main()
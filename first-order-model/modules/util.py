@@ -1,3 +1,5 @@
+import functools
+
 from torch import nn
 
 import torch.nn.functional as F
@@ -13,19 +15,14 @@ def kp2gaussian(kp, spatial_size, kp_variance):
     mean = kp['value']
 
     coordinate_grid = make_coordinate_grid(spatial_size, mean.type())
-    number_of_leading_dimensions = len(mean.shape) - 1
-    shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
-    coordinate_grid = coordinate_grid.view(*shape)
-    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1)
-    coordinate_grid = coordinate_grid.repeat(*repeats)
-
-    # Preprocess kp shape
-    shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 2)
-    mean = mean.view(*shape)
-
-    mean_sub = (coordinate_grid - mean)
+    # Squared distances along x (..., 1, w) and along y (..., h, 1) broadcast into (..., h, w),
+    # so the grid is never repeated for every keypoint
+    x = coordinate_grid[0, :, 0]
+    y = coordinate_grid[:, 0, 1].unsqueeze(-1)
+    mean_x = mean[..., 0].unsqueeze(-1).unsqueeze(-1)
+    mean_y = mean[..., 1].unsqueeze(-1).unsqueeze(-1)
 
-    out = torch.exp(-0.5 * (mean_sub ** 2).sum(-1) / kp_variance)
+    out = torch.exp(-0.5 * ((x - mean_x) ** 2 + (y - mean_y) ** 2) / kp_variance)
 
     return out
 
@@ -33,8 +30,16 @@ def kp2gaussian(kp, spatial_size, kp_variance):
 def make_coordinate_grid(spatial_size, type):
     """
     Create a meshgrid [-1,1] x [-1,1] of given spatial_size.
+    The grid is cached per size, type and device: don't modify it in place.
     """
     h, w = spatial_size
+    device = torch.cuda.current_device() if type.startswith('torch.cuda') else None
+    # A fresh view, so in-place reshapes of the caller don't reach the cache
+    return _coordinate_grid(int(h), int(w), type, device).view(h, w, 2)
+
+
+@functools.lru_cache(maxsize=32)
+def _coordinate_grid(h, w, type, device):
     x = torch.arange(w).type(type)
     y = torch.arange(h).type(type)
 
@@ -49,6 +54,17 @@ def make_coordinate_grid(spatial_size, type):
     return meshed
 
 
+def inverse_2x2(matrix):
+    """
+    Closed-form inverse of a batch of 2x2 matrices (..., 2, 2), cheaper than torch.inverse for jacobians
+    """
+    a, b = matrix[..., 0, 0], matrix[..., 0, 1]
+    c, d = matrix[..., 1, 0], matrix[..., 1, 1]
+    det = (a * d - b * c).unsqueeze(-1).unsqueeze(-1)
+    adjugate = torch.stack([torch.stack([d, -b], dim=-1), torch.stack([-c, a], dim=-1)], dim=-2)
+    return adjugate / det
+
+
 class ResBlock2d(nn.Module):
     """
     Res block, preserve spatial resolution.
@@ -0,0 +1,151 @@
+"""
+Inference-only rewrite of loaded models: batch norms are folded into the preceding convolutions.
+Run as a script to see the latency it saves per module:
+
+    python optimize.py --config config/vox-256.yaml --checkpoint vox-cpk.pth.tar --cpu
+"""
+import collections
+import copy
+import time
+from argparse import ArgumentParser
+
+import torch
+from torch import nn
+
+from modules.util import ResBlock2d, UpBlock2d, DownBlock2d, SameBlock2d
+from sync_batchnorm import SynchronizedBatchNorm2d
+
+# (conv, norm) attributes of the blocks where the norm directly follows the conv.
+# norm1 of ResBlock2d comes before its conv (pre-activation) and can't be folded.
+FOLDABLE = {SameBlock2d: [('conv', 'norm')], DownBlock2d: [('conv', 'norm')], UpBlock2d: [('conv', 'norm')],
+            ResBlock2d: [('conv1', 'norm2')]}
+BLOCKS = tuple(FOLDABLE)
+
+
+def fold_conv_norm(conv, norm):
+    """
+    Copy of conv with the eval-mode batch norm applied after it merged into the weight and bias
+    """
+    scale = torch.rsqrt(norm.running_var + norm.eps)
+    shift = -norm.running_mean * scale
+    if norm.affine:
+        scale = scale * norm.weight
+        shift = shift * norm.weight + norm.bias
+    fused = copy.deepcopy(conv)
+    fused.weight = nn.Parameter(conv.weight * scale.view(-1, 1, 1, 1))
+    bias = conv.bias * scale if conv.bias is not None else 0
+    fused.bias = nn.Parameter(bias + shift)
+    return fused
+
+
+def plain_batch_norm(norm):
+    """
+    nn.BatchNorm2d with the parameters and statistics of a SynchronizedBatchNorm2d
+    """
+    plain = nn.BatchNorm2d(norm.num_features, eps=norm.eps, momentum=norm.momentum, affine=norm.affine)
+    plain.load_state_dict(norm.state_dict())
+    return plain.to(norm.running_mean.device).eval()
+
+
+def fold_batch_norm(model):
+    """
+    Fold batch norms of a model in eval mode into the convolutions before them, the remaining
+    SynchronizedBatchNorm2d become plain nn.BatchNorm2d. The model is changed in place and can't be trained anymore.
+    """
+    if model.training:
+        raise ValueError("Batch norm can be folded only in eval mode")
+    with torch.no_grad():
+        for module in model.modules():
+            for conv_name, norm_name in FOLDABLE.get(type(module), []):
+                norm = getattr(module, norm_name)
+                if isinstance(norm, (SynchronizedBatchNorm2d, nn.BatchNorm2d)):
+                    setattr(module, conv_name, fold_conv_norm(getattr(module, conv_name), norm))
+                    setattr(module, norm_name, nn.Identity())
+        for module in list(model.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, SynchronizedBatchNorm2d):
+                    setattr(module, name, plain_batch_norm(child))
+    return model
+
+
+def module_latency(model, run, module_types=BLOCKS, repeats=5):
+    """
+    Milliseconds per run() spent in modules of module_types of the model, by class name, and in the whole run
+    """
+    cuda = next(model.parameters()).is_cuda
+    timings = collections.defaultdict(float)
+    starts = dict()
+
+    def sync():
+        if cuda:
+            torch.cuda.synchronize()
+
+    def before(module, inputs):
+        sync()
+        starts[module] = time.perf_counter()
+
+    def after(module, inputs, output):
+        sync()
+        timings[type(module).__name__] += time.perf_counter() - starts.pop(module)
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, module_types):
+            handles += [module.register_forward_pre_hook(before), module.register_forward_hook(after)]
+    try:
+        with torch.no_grad():
+            # Warm-up, lazy allocations are not counted
+            run()
+            timings.clear()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                run()
+            sync()
+            timings['total'] = time.perf_counter() - start
+    finally:
+        for handle in handles:
+            handle.remove()
+    return {name: seconds / repeats * 1000 for name, seconds in timings.items()}
+
+
+def latency_report(generator, kp_detector, cpu=False, batch_size=1, frame_shape=(256, 256), repeats=5):
+    """
+    Rows (model, module, ms before, ms after) of both models around fold_batch_norm, the models are folded in place
+    """
+    frames = torch.rand(batch_size, 3, *frame_shape)
+    if not cpu:
+        frames = frames.cuda()
+    with torch.no_grad():
+        kp = kp_detector(frames)
+    runs = {'kp_detector': (kp_detector, lambda: kp_detector(frames)),
+            'generator': (generator, lambda: generator(frames, kp_source=kp, kp_driving=kp, inference=True))}
+
+    before = {name: module_latency(model, run, repeats=repeats) for name, (model, run) in runs.items()}
+    for model, _ in runs.values():
+        fold_batch_norm(model)
+    after = {name: module_latency(model, run, repeats=repeats) for name, (model, run) in runs.items()}
+
+    rows = []
+    for name in runs:
+        for module in sorted(before[name], key=lambda module: module == 'total'):
+            rows.append((name, module, before[name][module], after[name].get(module, 0.0)))
+    return rows
+
+
+if __name__ == "__main__":
+    from demo import load_checkpoints
+
+    parser = ArgumentParser()
+    parser.add_argument("--config", required=True, help="path to config")
+    parser.add_argument("--checkpoint", default='vox-cpk.pth.tar', help="path to checkpoint to restore")
+    parser.add_argument("--cpu", dest="cpu", action="store_true", help="cpu mode.")
+    parser.add_argument("--batch_size", type=int, default=1, help="frames in every call")
+    parser.add_argument("--repeats", type=int, default=5, help="calls to average")
+    opt = parser.parse_args()
+
+    generator, kp_detector = load_checkpoints(config_path=opt.config, checkpoint_path=opt.checkpoint, cpu=opt.cpu,
+                                              fold_bn=False)
+    print(f"{'model':<14}{'module':<14}{'before, ms':>12}{'after, ms':>12}{'saved':>8}")
+    for model, module, before, after in latency_report(generator, kp_detector, cpu=opt.cpu,
+                                                       batch_size=opt.batch_size, repeats=opt.repeats):
+        print(f"{model:<14}{module:<14}{before:>12.2f}{after:>12.2f}{1 - after / before:>8.1%}")
@@ -0,0 +1,127 @@
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_END = object()
+
+
+class Pipeline:
+    """
+    Chain of streaming stages connected by bounded queues.
+    Every stage is a function that takes an iterator and returns an iterator, and runs in its own thread,
+    so at most `maxsize` items wait between two stages at any moment.
+    After run, timings contains the busy seconds of every stage and of the sink (time spent waiting
+    for a neighbour stage is not counted).
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.stages = []
+        self._stop = threading.Event()
+        self._errors = []
+        self.timings = dict()
+
+    def add(self, stage, name=None):
+        self.stages.append((name or getattr(stage, '__name__', 'stage'), stage))
+        return self
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _iterate(self, q):
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            if item is _END:
+                return
+            yield item
+
+    @staticmethod
+    def _timed(items, waited):
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            item = next(items, _END)
+            waited[0] += time.perf_counter() - start
+            if item is _END:
+                return
+            yield item
+
+    def _run_stage(self, name, stage, items, out, first):
+        # The first stage reads the source itself, other stages wait for the previous one
+        waited = [0.0]
+        if not first:
+            items = self._timed(items, waited)
+        start = time.perf_counter()
+        try:
+            for item in stage(items):
+                put_start = time.perf_counter()
+                if not self._put(out, item):
+                    break
+                waited[0] += time.perf_counter() - put_start
+        except BaseException as e:
+            self._errors.append((name, e))
+            self._stop.set()
+        finally:
+            self.timings[name] = time.perf_counter() - start - waited[0]
+            self._put(out, _END)
+
+    def run(self, items, sink, sink_name='sink'):
+        """
+        Push items through all stages and pass every result to sink in the calling thread
+        """
+        threads = []
+        for i, (name, stage) in enumerate(self.stages):
+            out = queue.Queue(self.maxsize)
+            threads.append(threading.Thread(target=self._run_stage, name=name, daemon=True,
+                                            args=(name, stage, items, out, i == 0)))
+            items = self._iterate(out)
+        for thread in threads:
+            thread.start()
+
+        self.timings[sink_name] = 0.0
+        try:
+            for item in items:
+                start = time.perf_counter()
+                sink(item)
+                self.timings[sink_name] += time.perf_counter() - start
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            name, error = self._errors[0]
+            raise error
+
+
+def parallel_map(fn, items, workers=4, executor=None):
+    """
+    Ordered map over a thread pool, with no more than 2 * workers items in flight.
+    A long-lived executor can be passed in, otherwise a pool is created for this call.
+    """
+    if executor is None:
+        with ThreadPoolExecutor(workers) as executor:
+            yield from parallel_map(fn, items, workers, executor)
+        return
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -31,6 +31,7 @@ def reconstruction(config, generator, kp_detector, checkpoint, log_dir, dataset)
 
     generator.eval()
     kp_detector.eval()
+    generator_module = generator.module if isinstance(generator, DataParallelWithCallback) else generator
 
     for it, x in tqdm(enumerate(dataloader)):
         if config['reconstruction_params']['num_videos'] is not None:
@@ -41,12 +42,13 @@ def reconstruction(config, generator, kp_detector, checkpoint, log_dir, dataset)
             visualizations = []
             if torch.cuda.is_available():
                 x['video'] = x['video'].cuda()
-            kp_source = kp_detector(x['video'][:, :, 0])
+            source = x['video'][:, :, 0]
+            kp_source = kp_detector(source)
+            source_state = generator_module.encode_source(source, kp_source)
             for frame_idx in range(x['video'].shape[2]):
-                source = x['video'][:, :, 0]
                 driving = x['video'][:, :, frame_idx]
                 kp_driving = kp_detector(driving)
-                out = generator(source, kp_source=kp_source, kp_driving=kp_driving)
+                out = generator_module.decode(source_state, kp_driving=kp_driving)
                 out['kp_source'] = kp_source
                 out['kp_driving'] = kp_driving
                 del out['sparse_deformed']
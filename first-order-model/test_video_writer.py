@@ -0,0 +1,85 @@
+"""
+FFmpegWriter and concat_videos keep every frame when the audio of the target is muxed in, and write the video
+without sound when the audio can't be copied into mp4.
+
+    python -m unittest test_video_writer
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import imageio
+import imageio_ffmpeg
+import numpy as np
+
+from video_writer import FFmpegWriter, concat_videos
+
+
+def count_frames(path):
+    return imageio_ffmpeg.count_frames_and_secs(path)[0]
+
+
+def has_audio(path):
+    result = subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), '-i', path], stderr=subprocess.PIPE)
+    return b'Audio:' in result.stderr
+
+
+class VideoWriterTestCase(unittest.TestCase):
+    fps = 25
+    frames = 40
+    settings = dict(codec='libx264', preset='ultrafast', crf=30)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.video = [rng.randint(0, 256, (64, 64, 3), dtype=np.uint8) for _ in range(self.frames)]
+        # Targets with the sound a little longer and a little shorter than the video, and one in a codec
+        # that can't be copied into mp4
+        self.targets = {name: self.make_target(name, seconds, codec)
+                        for name, seconds, codec in (('longer.mp4', 2, 'aac'), ('shorter.mp4', 1, 'aac'),
+                                                     ('mulaw.mkv', 2, 'pcm_mulaw'))}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_target(self, name, seconds, codec):
+        path = os.path.join(self.directory, name)
+        subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', 'sine=frequency=440:duration=%g' % seconds, '-c:a', codec, path], check=True)
+        return path
+
+    def write(self, path, frames, audio_source=None):
+        with FFmpegWriter(path, self.fps, audio_source=audio_source, **self.settings) as writer:
+            for frame in frames:
+                writer.append_data(frame)
+        return path
+
+    def test_every_frame_is_kept(self):
+        for name, target in self.targets.items():
+            path = self.write(os.path.join(self.directory, 'result_' + name + '.mp4'), self.video, target)
+            self.assertEqual(count_frames(path), self.frames, name)
+            self.assertEqual(has_audio(path), not name.startswith('mulaw'), name)
+            self.assertFalse(os.path.exists(path + '.video.mp4'))
+
+    def test_chunks_match_the_sequential_video(self):
+        sequential = self.write(os.path.join(self.directory, 'sequential.mp4'), self.video,
+                                self.targets['shorter.mp4'])
+        parts = [self.write(os.path.join(self.directory, 'part%d.mp4' % i), self.video[start:stop])
+                 for i, (start, stop) in enumerate([(0, 13), (13, 27), (27, self.frames)])]
+        for name, target in self.targets.items():
+            joined = os.path.join(self.directory, 'joined_' + name + '.mp4')
+            concat_videos(parts, joined, audio_source=target)
+            self.assertEqual(count_frames(joined), self.frames, name)
+            self.assertEqual(has_audio(joined), not name.startswith('mulaw'), name)
+        # Chunks are encoded on their own, so their frames are compared with a tolerance of the codec
+        chunked = imageio.mimread(os.path.join(self.directory, 'joined_shorter.mp4.mp4'), memtest=False)
+        expected = imageio.mimread(sequential, memtest=False)
+        self.assertEqual(len(chunked), len(expected))
+        for frame, reference in zip(chunked, expected):
+            self.assertLess(np.abs(frame.astype(int) - reference).mean(), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
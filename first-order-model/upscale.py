@@ -0,0 +1,80 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from pipeline import parallel_map
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pretrained_models')
+
+# Quality/speed tiers, from the slowest to the fastest
+TIERS = ('espcn', 'lanczos', 'none')
+
+
+class SuperResolution:
+    """
+    Frame upscaler. The ESPCN model is read once per thread (cv2 dnn objects must not be shared between threads),
+    batches of frames are processed by a persistent thread pool.
+    Tiers: 'espcn' (ESPCN_x{scale}.pb, scale 2, 3 or 4), 'lanczos' (plain resize) and 'none'.
+    """
+
+    def __init__(self, tier='espcn', scale=4, threads=2, model_dir=MODEL_DIR):
+        if tier not in TIERS:
+            raise ValueError("Unknown super resolution tier %s, use one of %s" % (tier, TIERS))
+        self.tier = tier
+        self.scale = scale
+        self.threads = threads
+        self.model_path = os.path.join(model_dir, 'ESPCN_x%d.pb' % scale)
+        if tier == 'espcn' and not os.path.exists(self.model_path):
+            raise FileNotFoundError(self.model_path)
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(threads)
+
+    def _model(self):
+        sr = getattr(self._local, 'sr', None)
+        if sr is None:
+            sr = cv2.dnn_superres.DnnSuperResImpl_create()
+            sr.readModel(self.model_path)
+            sr.setModel('espcn', self.scale)
+            self._local.sr = sr
+        return sr
+
+    def __call__(self, frame):
+        """
+        Upscale a single uint8 frame in the calling thread
+        """
+        if self.tier == 'none' or self.scale == 1:
+            return frame
+        if self.tier == 'lanczos':
+            return cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_LANCZOS4)
+        return self._model().upsample(frame)
+
+    def upscale_batch(self, frames):
+        return list(self._executor.map(self, frames))
+
+    def iter_upscale(self, frames):
+        """
+        Lazy ordered upscaling of a stream of frames over the thread pool
+        """
+        if self.tier == 'none':
+            return iter(frames)
+        return parallel_map(self, frames, workers=self.threads, executor=self._executor)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+_upscalers = dict()
+_upscalers_lock = threading.Lock()
+
+
+def get_upscaler(tier='espcn', scale=4, threads=2):
+    """
+    Upscaler shared by the whole process
+    """
+    with _upscalers_lock:
+        key = (tier, scale, threads)
+        if key not in _upscalers:
+            _upscalers[key] = SuperResolution(tier, scale, threads=threads)
+        return _upscalers[key]
@@ -0,0 +1,140 @@
+import logging
+import os
+import subprocess
+
+import imageio_ffmpeg
+
+
+def _run_ffmpeg(cmd, path):
+    result = subprocess.run(cmd, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        if os.path.exists(path):
+            os.remove(path)
+        raise RuntimeError("ffmpeg failed to write %s: %s" % (path, result.stderr.decode(errors='replace').strip()))
+
+
+def _with_audio(cmd, video_input, path, audio_source, audio_codec):
+    """
+    Run cmd (ffmpeg arguments up to the inputs) with the audio of audio_source muxed into path.
+    If the audio can't be copied (e.g. a codec the container doesn't support), it is run again without it.
+    The video is never cut to the audio: it has exactly the frames of the target.
+    """
+    output = ['-c:v', 'copy', '-movflags', '+faststart', path]
+    if audio_source is not None:
+        try:
+            # '?' keeps targets without sound working
+            return _run_ffmpeg(cmd + video_input + ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?',
+                                                    '-c:a', audio_codec] + output, path)
+        except RuntimeError as e:
+            logging.warning("%s, writing the video without sound" % e)
+    _run_ffmpeg(cmd + video_input + output, path)
+
+
+def mux_audio(video_path, path, audio_source, audio_codec='copy'):
+    """
+    Copy the video of video_path into path with the audio of audio_source, nothing is re-encoded
+    """
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error']
+    _with_audio(cmd, ['-i', video_path], path, audio_source, audio_codec)
+
+
+class FFmpegWriter:
+    """
+    Pipes raw RGB frames into a single ffmpeg process, which encodes the video, so the result never has to be
+    decoded again. The audio of audio_source is muxed afterwards by stream copy (see mux_audio).
+    The ffmpeg process starts with the first frame, when the frame size is known.
+    """
+
+    def __init__(self, path, fps, audio_source=None, codec='libx264', preset='veryfast', crf=20,
+                 pix_fmt='yuv420p', audio_codec='copy'):
+        self.path = path
+        self.fps = fps
+        self.audio_source = audio_source
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.pix_fmt = pix_fmt
+        self.audio_codec = audio_codec
+        self.frames = 0
+        self._process = None
+        # With sound the frames are encoded into a separate file first, so a failed audio copy can be run again
+        self._video_path = path if audio_source is None else path + '.video.mp4'
+
+    def command(self, width, height):
+        cmd = [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (width, height), '-r', str(self.fps),
+               '-i', '-', '-c:v', self.codec, '-pix_fmt', self.pix_fmt, '-crf', str(self.crf)]
+        if self.preset is not None:
+            cmd += ['-preset', self.preset]
+        return cmd + ['-movflags', '+faststart', self._video_path]
+
+    def append_data(self, frame):
+        if self._process is None:
+            height, width = frame.shape[:2]
+            self._process = subprocess.Popen(self.command(width, height), stdin=subprocess.PIPE,
+                                             stderr=subprocess.PIPE)
+        try:
+            self._process.stdin.write(frame[..., :3].tobytes())
+        except BrokenPipeError:
+            self._fail()
+        self.frames += 1
+
+    def _fail(self):
+        error = self._process.stderr.read().decode(errors='replace').strip()
+        self._process.wait()
+        raise RuntimeError("ffmpeg failed to write %s: %s" % (self.path, error))
+
+    def close(self):
+        if self._process is None:
+            raise RuntimeError("No frames were written to %s" % self.path)
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self._process.wait() != 0:
+            self._fail()
+        if self.audio_source is not None:
+            try:
+                mux_audio(self._video_path, self.path, self.audio_source, self.audio_codec)
+            finally:
+                os.remove(self._video_path)
+
+    def abort(self):
+        """
+        Stop ffmpeg and remove the unfinished files
+        """
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        for path in {self._video_path, self.path}:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except Exception:
+            self.abort()
+            raise
+
+
+def concat_videos(paths, path, audio_source=None, audio_codec='copy'):
+    """
+    Join videos encoded with the same settings (e.g. by FFmpegWriter) without re-encoding them,
+    the audio of audio_source is muxed in the same pass (without it, if it can't be copied)
+    """
+    list_path = path + '.txt'
+    with open(list_path, 'w') as f:
+        for part in paths:
+            f.write("file '%s'\n" % os.path.abspath(part).replace("'", "'\\''"))
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error']
+    try:
+        _with_audio(cmd, ['-f', 'concat', '-safe', '0', '-i', list_path], path, audio_source, audio_codec)
+    finally:
+        os.remove(list_path)